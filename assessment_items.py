@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+"""
+Helpers for fetching the Perseus assessment items of KA exercises from the
+khanacademy.org GraphQL API. The items of many exercises are combined into
+batched requests, which are much faster than one request per exercise:
+
+    ./assessment_items.py --benchmark   # compare against a local mock server
+
+"""
+import argparse
+import atexit
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from ricecooker import config
+from ricecooker.config import LOGGER
+
+from network import get_concurrency_limiter
+from network import MAX_CONCURRENCY_LIMIT
+from network import post_request
+from network import RequestFailedError
+
+
+ASSESSMENT_ITEMS_URL = (
+    "https://{kalang}.khanacademy.org/graphql/LearningEquality_assessmentItems"
+)
+
+# Maximum number of item descriptors to send in a single batched request
+MAX_ITEMS_PER_REQUEST = 100
+
+# Maximum number of batched requests that are fetched concurrently during
+# prefetching; the actual number adapts to the server (see network.py)
+PREFETCH_WORKERS = MAX_CONCURRENCY_LIMIT
+
+# Log the prefetch counters every time this many exercises are completed
+PREFETCH_LOG_INTERVAL = 500
+
+MISSING_ITEM_ERROR = "assessment item not found in exercise"
+
+# Local store of the fetched items that is shared by all the chef runs
+ASSESSMENT_ITEMS_DB = os.path.join("chefdata", "assessmentitems.sqlite3")
+
+# Items in the store that are older than this are fetched again
+ASSESSMENT_ITEMS_MAX_AGE_DAYS = 30
+
+
+assessment_item_query = """
+query LearningEquality_assessmentItems($itemDescriptors: [String]!) {
+    assessmentItems(reservedItemDescriptors: $itemDescriptors) {
+        id
+        itemData
+    }
+}
+"""
+
+
+def get_assessment_items_url(kalang):
+    return ASSESSMENT_ITEMS_URL.format(kalang=kalang)
+
+
+def get_query_data(item_pairs):
+    """
+    Returns the GraphQL query data for the list of `(exercise_id, item_id)` pairs.
+    """
+    return {
+        "query": assessment_item_query,
+        "variables": {
+            "itemDescriptors": [
+                "{}|{}".format(exercise_id, item_id)
+                for exercise_id, item_id in item_pairs
+            ]
+        },
+    }
+
+
+def _post_item_pairs(url, item_pairs):
+    """
+    Request the assessment items for `item_pairs` from the GraphQL API at `url`.
+    Returns a tuple (items, missing) where `items` is the list of item dicts
+    (None if the request failed) and `missing` is True when some of the items
+    were not found in their exercise.
+    """
+    try:
+        response_data = post_request(url, get_query_data(item_pairs))
+    except RequestFailedError as e:
+        LOGGER.warning(str(e))
+        return None, False
+    # It seems that sometimes assessmentItems can be None.
+    items = (response_data.get("data") or {}).get("assessmentItems") or []
+    errors = response_data.get("errors") or []
+    missing = any(MISSING_ITEM_ERROR in error.get("message", "") for error in errors)
+    return items, missing
+
+
+def _bisect_item_pairs(url, item_pairs):
+    """
+    Request the assessment items for `item_pairs`, and if some of them are not
+    found, split the pairs in two halves and request each half again, recursing
+    only into the halves that still contain missing items.
+    Returns a tuple (items, missing_pairs, failed_pairs) where `missing_pairs`
+    are the item pairs that were confirmed not found, and `failed_pairs` are the
+    item pairs whose request failed (so they may or may not exist).
+    """
+    items, missing = _post_item_pairs(url, item_pairs)
+    if items is None:
+        return [], [], list(item_pairs)
+    if not missing:
+        return items, [], []
+    if len(item_pairs) == 1:
+        return [], list(item_pairs), []
+    middle = len(item_pairs) // 2
+    items, missing_pairs, failed_pairs = [], [], []
+    for half in (item_pairs[:middle], item_pairs[middle:]):
+        half_items, half_missing_pairs, half_failed_pairs = _bisect_item_pairs(
+            url, half
+        )
+        items.extend(half_items)
+        missing_pairs.extend(half_missing_pairs)
+        failed_pairs.extend(half_failed_pairs)
+    return items, missing_pairs, failed_pairs
+
+
+def fetch_exercise_assessment_items(url, exercise_id, item_ids):
+    """
+    Fetch the assessment items `item_ids` of the exercise `exercise_id`.
+    If some of the items are missing, they are found by bisection.
+    Returns: list of item dicts with keys `id` and `itemData`, or None if the
+    request for any of the items failed.
+    """
+    item_pairs = [(exercise_id, item_id) for item_id in item_ids]
+    items, _, failed_pairs = _bisect_item_pairs(url, item_pairs)
+    if failed_pairs:
+        return None
+    return items
+
+
+class AssessmentItemStore:
+    """
+    Persistent store of the assessment items fetched for the KA language `kalang`,
+    keyed by (kalang, exercise id, item id), with the time each item was fetched.
+    Items older than `max_age_days` are considered stale and are fetched again.
+    Items that were not found in their exercise are stored with item_data NULL,
+    so they are not requested again until they become stale. With the chef's
+    `--update` option all the items are fetched again (and saved).
+    The same sqlite database is shared by all languages, variants, and runs.
+    """
+
+    def __init__(
+        self,
+        kalang,
+        db_path=ASSESSMENT_ITEMS_DB,
+        max_age_days=ASSESSMENT_ITEMS_MAX_AGE_DAYS,
+    ):
+        self.kalang = kalang
+        self.max_age = max_age_days * 24 * 3600
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS items (
+                    kalang TEXT NOT NULL,
+                    exercise_id TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    item_data TEXT,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (kalang, exercise_id, item_id)
+                ) WITHOUT ROWID"""
+            )
+
+    def get_item_data(self, exercise_id, item_id):
+        """
+        Returns the item data of the item `item_id` (None if not in the store).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT item_data FROM items "
+                "WHERE kalang = ? AND exercise_id = ? AND item_id = ?",
+                (self.kalang, exercise_id, item_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_items(self, exercise_id, item_ids):
+        """
+        Returns a dict {item_id --> item dict} of the items that are in the store
+        and are not stale. Items that are known to be missing map to None.
+        """
+        if config.UPDATE:
+            return {}
+        min_fetched_at = time.time() - self.max_age
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT item_id, item_data FROM items "
+                "WHERE kalang = ? AND exercise_id = ? AND fetched_at >= ?",
+                (self.kalang, exercise_id, min_fetched_at),
+            ).fetchall()
+        item_ids = set(item_ids)
+        return dict(
+            (item_id, {"id": item_id, "itemData": item_data} if item_data else None)
+            for item_id, item_data in rows
+            if item_id in item_ids
+        )
+
+    def save_items(self, exercise_id, items):
+        self._save_rows(exercise_id, [(item["id"], item["itemData"]) for item in items])
+
+    def save_missing_items(self, exercise_id, item_ids):
+        self._save_rows(exercise_id, [(item_id, None) for item_id in item_ids])
+
+    def _save_rows(self, exercise_id, rows):
+        fetched_at = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO items "
+                "(kalang, exercise_id, item_id, item_data, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.kalang, exercise_id, item_id, item_data, fetched_at)
+                    for item_id, item_data in rows
+                ],
+            )
+
+
+def get_item_ids_with_data(items):
+    """
+    Returns the ids of the `items` that have item data.
+    """
+    return [
+        item["id"] for item in items if item["itemData"] and item["itemData"] != "null"
+    ]
+
+
+class QuestionSpillStore:
+    """
+    Temporary on-disk store for the Perseus data of questions (after the image
+    URLs are replaced during processing), so that it is not kept in memory until
+    the tree is uploaded. The database file is removed when the process exits.
+    """
+
+    def __init__(self, dir=None):
+        fd, self.db_path = tempfile.mkstemp(suffix=".sqlite3", dir=dir)
+        os.close(fd)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE questions (key TEXT PRIMARY KEY, raw_data TEXT NOT NULL)"
+            )
+        atexit.register(self.close)
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT raw_data FROM questions WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, raw_data):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO questions (key, raw_data) VALUES (?, ?)",
+                (key, raw_data),
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        os.remove(self.db_path)
+
+
+def make_batches(items_by_exercise, max_items=MAX_ITEMS_PER_REQUEST):
+    """
+    Group the items in the dict `items_by_exercise` {exercise_id --> item_ids}
+    into batches of at most `max_items` (exercise_id, item_id) pairs. The items
+    of an exercise are never split across batches, so exercises that have more
+    than `max_items` items get a batch of their own.
+    """
+    batch = []
+    for exercise_id, item_ids in items_by_exercise.items():
+        if batch and len(batch) + len(item_ids) > max_items:
+            yield batch
+            batch = []
+        batch.extend((exercise_id, item_id) for item_id in item_ids)
+    if batch:
+        yield batch
+
+
+def _split_items_by_exercise(item_pairs, items):
+    """
+    Split the `items` returned for the batch `item_pairs` by exercise.
+    Returns: dict {exercise_id --> list of item dicts}
+    """
+    exercise_ids_by_item_id = {}
+    items_by_exercise = {}
+    for exercise_id, item_id in item_pairs:
+        exercise_ids_by_item_id.setdefault(item_id, []).append(exercise_id)
+        items_by_exercise[exercise_id] = []
+    for item in items:
+        for exercise_id in exercise_ids_by_item_id.get(item["id"], []):
+            items_by_exercise[exercise_id].append(item)
+    return items_by_exercise
+
+
+def fetch_assessment_items(
+    url, items_by_exercise, max_items=MAX_ITEMS_PER_REQUEST, store=None
+):
+    """
+    Fetch the assessment items for all the exercises in `items_by_exercise`,
+    a dict {exercise_id --> list of item ids}, using batched requests.
+    If an AssessmentItemStore `store` is given, only the items that are not in
+    the store (or are stale) are requested, and the fetched items are saved
+    together with the items that were confirmed missing.
+    Returns: dict {exercise_id --> list of item dicts}. Exercises whose request
+    failed are not included in the result.
+    """
+    if store is None:
+        results, _ = _fetch_assessment_items(url, items_by_exercise, max_items)
+        return results
+
+    stored_by_exercise = {}
+    items_to_fetch = {}
+    for exercise_id, item_ids in items_by_exercise.items():
+        stored = store.get_items(exercise_id, item_ids)
+        stored_by_exercise[exercise_id] = stored
+        missing_item_ids = [item_id for item_id in item_ids if item_id not in stored]
+        if missing_item_ids:
+            items_to_fetch[exercise_id] = missing_item_ids
+
+    fetched, missing_pairs = _fetch_assessment_items(url, items_to_fetch, max_items)
+    for exercise_id, items in fetched.items():
+        store.save_items(exercise_id, items)
+    missing_by_exercise = {}
+    for exercise_id, item_id in missing_pairs:
+        missing_by_exercise.setdefault(exercise_id, []).append(item_id)
+    for exercise_id, item_ids in missing_by_exercise.items():
+        store.save_missing_items(exercise_id, item_ids)
+
+    results = {}
+    for exercise_id, item_ids in items_by_exercise.items():
+        if exercise_id in items_to_fetch and exercise_id not in fetched:
+            continue  # the request failed
+        items_by_id = dict(stored_by_exercise[exercise_id])
+        items_by_id.update((item["id"], item) for item in fetched.get(exercise_id, []))
+        results[exercise_id] = [
+            items_by_id[item_id]
+            for item_id in item_ids
+            if items_by_id.get(item_id) is not None
+        ]
+    return results
+
+
+def _fetch_assessment_items(url, items_by_exercise, max_items):
+    """
+    Returns a tuple (results, missing_pairs) with the items by exercise and the
+    (exercise_id, item_id) pairs that were confirmed not found. Exercises with
+    items whose request failed are not included in the results, since their
+    list of items would be incomplete.
+    """
+    results, missing_pairs = {}, []
+    for batch in make_batches(items_by_exercise, max_items=max_items):
+        items, batch_missing_pairs, failed_pairs = _bisect_item_pairs(url, batch)
+        batch_results = _split_items_by_exercise(batch, items)
+        for exercise_id, _ in failed_pairs:
+            batch_results.pop(exercise_id, None)
+        results.update(batch_results)
+        missing_pairs.extend(batch_missing_pairs)
+    return results, missing_pairs
+
+
+# PREFETCH
+################################################################################
+
+
+class AssessmentItemsPrefetcher:
+    """
+    Fetch the assessment items of exercises in the background while the topic
+    tree is being built. Each call to `add` queues the items of one exercise,
+    and as soon as `max_items` items are queued the batch is fetched by a pool
+    of `max_workers` threads. The items are available from the future returned
+    by `add`, which is resolved with None if the exercise's request failed.
+    Call `flush` once all the exercises have been added. The optional callback
+    `on_fetched` is called with the list of items of each fetched exercise.
+    The futures are only kept until they are resolved, so that their results are
+    freed once the exercises have consumed them.
+    With `keep_items=False` the futures are resolved with the ids of the items
+    that have data instead, and the items must be read from the `store`.
+    """
+
+    def __init__(
+        self,
+        url,
+        max_workers=PREFETCH_WORKERS,
+        max_items=MAX_ITEMS_PER_REQUEST,
+        log_interval=PREFETCH_LOG_INTERVAL,
+        store=None,
+        on_fetched=None,
+        keep_items=True,
+    ):
+        self.url = url
+        self.store = store
+        self.on_fetched = on_fetched
+        self.keep_items = keep_items
+        self.max_items = max_items
+        self.log_interval = log_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="itemprefetch"
+        )
+        self.futures = {}  # {exercise_id --> Future} of the unresolved exercises
+        self.pending = {}  # {exercise_id --> item_ids} for the next batch
+        self.num_pending_items = 0
+        self.lock = threading.Lock()
+        self.counters = {"queued": 0, "in_flight": 0, "done": 0, "failed": 0}
+
+    def add(self, exercise_id, item_ids):
+        """
+        Queue the items `item_ids` of the exercise `exercise_id` for fetching,
+        unless the exercise is already queued or in flight.
+        Returns: a Future that resolves to the list of item dicts.
+        """
+        with self.lock:
+            if exercise_id in self.futures:
+                return self.futures[exercise_id]
+            future = Future()
+            self.futures[exercise_id] = future
+            self.pending[exercise_id] = item_ids
+            self.num_pending_items += len(item_ids)
+            self.counters["queued"] += 1
+            if self.num_pending_items >= self.max_items:
+                self._submit_pending()
+        return future
+
+    def flush(self):
+        """
+        Submit the remaining queued exercises. The worker threads are released
+        once all the batches are done.
+        """
+        with self.lock:
+            if self.pending:
+                self._submit_pending()
+        self.executor.shutdown(wait=False)
+
+    def wait(self):
+        """
+        Block until all the exercises added so far have been fetched.
+        """
+        self.flush()
+        for future in list(self.futures.values()):
+            future.exception()
+        self.log_counters()
+
+    def _submit_pending(self):
+        items_by_exercise = self.pending
+        self.pending = {}
+        self.num_pending_items = 0
+        self.counters["queued"] -= len(items_by_exercise)
+        self.counters["in_flight"] += len(items_by_exercise)
+        self.executor.submit(self._fetch_batch, items_by_exercise)
+
+    def _fetch_batch(self, items_by_exercise):
+        try:
+            results = fetch_assessment_items(
+                self.url, items_by_exercise, max_items=self.max_items, store=self.store
+            )
+        except Exception as e:
+            LOGGER.error("Failed to fetch assessment items batch: " + str(e))
+            results = {}
+        with self.lock:
+            for exercise_id in items_by_exercise:
+                self.counters["in_flight"] -= 1
+                if exercise_id in results:
+                    self.counters["done"] += 1
+                else:
+                    self.counters["failed"] += 1
+            completed = self.counters["done"] + self.counters["failed"]
+            log_now = completed // self.log_interval != (
+                completed - len(items_by_exercise)
+            ) // self.log_interval
+        # The futures are always resolved, since the exercises block on them
+        resolved = {}
+        try:
+            if self.on_fetched:
+                for items in results.values():
+                    try:
+                        self.on_fetched(items)
+                    except Exception as e:
+                        LOGGER.error("Failed to process fetched items: " + str(e))
+            if not self.keep_items:
+                results = dict(
+                    (exercise_id, get_item_ids_with_data(items))
+                    for exercise_id, items in results.items()
+                )
+            resolved = results
+        finally:
+            with self.lock:
+                futures = dict(
+                    (exercise_id, self.futures.pop(exercise_id))
+                    for exercise_id in items_by_exercise
+                )
+            for exercise_id, future in futures.items():
+                future.set_result(resolved.get(exercise_id))
+        if log_now:
+            self.log_counters()
+
+    def log_counters(self):
+        LOGGER.info(
+            "Assessment items prefetch: {queued} queued, {in_flight} in flight, "
+            "{done} done, {failed} failed exercises".format(**self.counters)
+        )
+        LOGGER.info(
+            "Assessment items requests: concurrency limit {limit}, "
+            "{throughput:.1f} requests/s, {errors} errors, {throttled} throttled".format(
+                **get_concurrency_limiter(self.url).get_metrics()
+            )
+        )
+
+
+# BENCHMARK
+################################################################################
+
+
+class MockGraphQLHandler(BaseHTTPRequestHandler):
+    """
+    Mock of the LearningEquality_assessmentItems GraphQL endpoint that replies
+    after `latency` seconds. Items whose id starts with "missing" are not found.
+    """
+
+    latency = 0.05
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        descriptors = data["variables"]["itemDescriptors"]
+        item_ids = [descriptor.split("|")[1] for descriptor in descriptors]
+        if any(item_id.startswith("missing") for item_id in item_ids):
+            response = {
+                "data": {"assessmentItems": None},
+                "errors": [{"message": MISSING_ITEM_ERROR}],
+            }
+        else:
+            response = {
+                "data": {
+                    "assessmentItems": [
+                        {"id": item_id, "itemData": json.dumps({"id": item_id})}
+                        for item_id in item_ids
+                    ]
+                }
+            }
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_benchmark(num_exercises=200, num_items=8, latency=0.05, num_missing=0):
+    """
+    Compare the total wall time of one request per exercise vs. batched requests
+    against a local mock GraphQL server that replies after `latency` seconds.
+    """
+    MockGraphQLHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockGraphQLHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/graphql".format(server.server_address[1])
+
+    items_by_exercise = {}
+    for i in range(num_exercises):
+        item_ids = ["x{}i{}".format(i, j) for j in range(num_items)]
+        if i < num_missing:
+            item_ids[-1] = "missing{}".format(i)
+        items_by_exercise["x{}".format(i)] = item_ids
+
+    start = time.time()
+    for exercise_id, item_ids in items_by_exercise.items():
+        fetch_exercise_assessment_items(url, exercise_id, item_ids)
+    per_exercise_time = time.time() - start
+
+    start = time.time()
+    results = fetch_assessment_items(url, items_by_exercise)
+    batched_time = time.time() - start
+    server.shutdown()
+
+    num_fetched = sum(len(items) for items in results.values())
+    print(
+        "Exercises: {}, items per exercise: {}, missing: {}, latency: {}s".format(
+            num_exercises, num_items, num_missing, latency
+        )
+    )
+    print("One request per exercise: {:.2f}s".format(per_exercise_time))
+    print("Batched requests:         {:.2f}s ({} items)".format(batched_time, num_fetched))
+
+
+# CLI
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KA assessment items helpers")
+    parser.add_argument(
+        "--benchmark", action="store_true", help="run against a mock GraphQL server"
+    )
+    parser.add_argument("--exercises", type=int, default=200, help="# of exercises")
+    parser.add_argument("--items", type=int, default=8, help="# items per exercise")
+    parser.add_argument(
+        "--missing", type=int, default=0, help="# exercises with missing items"
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="server latency")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(
+            num_exercises=args.exercises,
+            num_items=args.items,
+            latency=args.latency,
+            num_missing=args.missing,
+        )
@@ -4,6 +4,12 @@ rules for the Khan Academy nodes that are applied as part of the creation of the
 corresponding Kolibri channel.
 """
 
+from collections import ChainMap
+import fnmatch
+from functools import lru_cache
+import re
+from types import MappingProxyType
+
 from ricecooker.config import LOGGER
 from le_utils.constants.labels import levels
 from le_utils.constants.labels import subjects
@@ -109,6 +115,8 @@ GLOBAL_SLUG_BLACKLIST += [
 
 # Additional SLUG_BLACKLIST for specific languages and variants
 # The keys are either internal lang codes (str) or (lang, variant) tuples (str, str)
+# Entries that contain glob wildcards like "*-innova-schools" or "innova-*" are
+# matched as patterns against the slugs (see SlugBlacklist below).
 SLUG_BLACKLIST_PER_LANG = {
     "zh-CN": [
         "money-and-banking",  # Mar 25 contains mostly non-public youtube videos
@@ -144,20 +152,61 @@ SLUG_BLACKLIST_PER_LANG = {
 }
 
 
+class SlugBlacklist(frozenset):
+    """
+    Immutable set of KA slugs to skip. Plain slugs are checked with a set lookup,
+    while entries that contain glob wildcards (`*`, `?`, `[`) are combined into
+    a single regular expression that is used for the remaining slugs.
+    """
+
+    def __new__(cls, entries=()):
+        entries = list(entries)
+        patterns = tuple(entry for entry in entries if _is_slug_pattern(entry))
+        blacklist = super(SlugBlacklist, cls).__new__(
+            cls, (entry for entry in entries if not _is_slug_pattern(entry))
+        )
+        blacklist.patterns = patterns
+        if patterns:
+            blacklist._patterns_re = re.compile(
+                "|".join(fnmatch.translate(pattern) for pattern in patterns)
+            )
+        else:
+            blacklist._patterns_re = None
+        return blacklist
+
+    def __contains__(self, slug):
+        if super(SlugBlacklist, self).__contains__(slug):
+            return True
+        return self._patterns_re is not None and bool(self._patterns_re.match(slug))
+
+    def __repr__(self):
+        return "SlugBlacklist({} slugs, patterns={})".format(
+            len(self), list(self.patterns)
+        )
+
+
+def _is_slug_pattern(entry):
+    return any(char in entry for char in "*?[")
+
+
+@lru_cache(maxsize=None)
 def get_slug_blacklist(lang=None, variant=None):
     """
-    Returns a list of KA slugs to skip when creating the channel.
+    Returns the SlugBlacklist of KA slugs to skip when creating the channel.
     Combines the "global" slug blacklist that applies for all channels, and
     additional customization for specific languages or curriculum variants.
+    The result is computed once per (lang, variant) and never modifies the
+    module-level blacklist data, so it's safe to build several channels in the
+    same process.
     """
-    SLUG_BLACKLIST = GLOBAL_SLUG_BLACKLIST
+    slugs = list(GLOBAL_SLUG_BLACKLIST)
     if variant and (lang, variant) in SLUG_BLACKLIST_PER_LANG:
-        SLUG_BLACKLIST.extend(SLUG_BLACKLIST_PER_LANG[(lang, variant)])
+        slugs.extend(SLUG_BLACKLIST_PER_LANG[(lang, variant)])
     elif lang in SLUG_BLACKLIST_PER_LANG:
-        SLUG_BLACKLIST.extend(SLUG_BLACKLIST_PER_LANG[lang])
+        slugs.extend(SLUG_BLACKLIST_PER_LANG[lang])
     else:
-        LOGGER.warning("No slugs for lang=" + lang + " variant=" + str(variant))
-    return SLUG_BLACKLIST
+        LOGGER.warning("No slugs for lang=" + str(lang) + " variant=" + str(variant))
+    return SlugBlacklist(slugs)
 
 
 # Topic tree replacments (slug --> list of subtrees of slug include directives)
@@ -2155,6 +2204,88 @@ def get_topic_tree_replacements(lang=None, variant=None):
         return {}
 
 
+# Row used in place of topics that are listed in the replacements but are not
+# present in the TSV data (the resulting topic has no children and is skipped)
+MISSING_REPLACEMENT_TOPIC = MappingProxyType(
+    {
+        "translated_description_html": "",
+        "curriculum_key": "",
+        "kind": "Course",
+        "fully_translated": True,
+    }
+)
+
+
+def _compile_replacement_child(parent_slug, child, topics_by_slug, missing_slugs):
+    """
+    Return an overlay node for the replacement directive `child` of the topic
+    `parent_slug`. The overlay reads through to the original TSV topic row, so
+    only the fields that differ (id, titles, slug, children) are stored.
+    """
+    row = topics_by_slug.get(child["slug"])
+    if row is None:
+        missing_slugs.append(child["slug"])
+        row = MISSING_REPLACEMENT_TOPIC
+    overrides = {
+        "id": "{}_{}".format(parent_slug, child["slug"]),
+        "original_title": child.get("translatedTitle", row.get("original_title", "")),
+        "translated_title": child.get(
+            "translatedTitle", row.get("translated_title", "")
+        ),
+        "slug": child["slug"],
+    }
+    if "children" in child:
+        overrides["replacement_children"] = tuple(
+            _compile_replacement_child(
+                child["slug"], gchild, topics_by_slug, missing_slugs
+            )
+            for gchild in child["children"]
+        )
+    return ChainMap(overrides, row)
+
+
+def compile_topic_tree_replacements(topics_by_slug, lang=None, variant=None):
+    """
+    Compile the replacement directives for `lang` and `variant` against the
+    TSV topic rows in `topics_by_slug` (a {slug --> row} dict).
+    Returns: a dict {slug --> tuple of replacements}, where each replacement is
+    a dict with the keys `slug`, `title` (None if not specified), and `children`
+    (a tuple of read-only overlay nodes that reference the original rows).
+    All the slugs are checked once up front and the missing ones are reported.
+    """
+    compiled = {}
+    missing_slugs = []
+    replacements_by_slug = get_topic_tree_replacements(lang=lang, variant=variant)
+    for slug, replacements in replacements_by_slug.items():
+        compiled[slug] = tuple(
+            {
+                "slug": replacement.get("slug", slug),
+                "title": replacement.get("translatedTitle"),
+                "children": tuple(
+                    _compile_replacement_child(
+                        replacement.get("slug", slug),
+                        child,
+                        topics_by_slug,
+                        missing_slugs,
+                    )
+                    for child in replacement["children"]
+                ),
+            }
+            for replacement in replacements
+        )
+    if missing_slugs:
+        LOGGER.warning(
+            "Topic replacements for lang={} variant={} reference {} slugs missing "
+            "from the TSV data: {}".format(
+                lang,
+                variant,
+                len(set(missing_slugs)),
+                ", ".join(dict.fromkeys(missing_slugs)),
+            )
+        )
+    return compiled
+
+
 METADATA_BY_SLUG = {
     "math": {
         "grade_levels": [],
@@ -22,6 +22,8 @@ import sqlite3
 import subprocess
 import uuid
 
+from le_utils.constants import format_presets
+
 
 # DATABASE
 ################################################################################
@@ -208,13 +210,189 @@ def get_nodes_by_id(conn, attach_files=True, attach_assessments=True):
     return nodes_by_id
 
 
+class RemoteNodesIndex:
+    """
+    Lookups of the nodes of a published channel that can be reused by the chef:
+    the ids of the nodes that have a high or low res video file (loaded with a
+    single query) and the assessment metadata of exercises (queried per node).
+    An index without `db_file_path` is empty.
+    """
+
+    VIDEO_PRESETS = [format_presets.VIDEO_HIGH_RES, format_presets.VIDEO_LOW_RES]
+
+    def __init__(self, db_file_path=None):
+        self.conn = None
+        self.video_node_ids = frozenset()
+        if db_file_path:
+            uri = "file:{}?mode=ro".format(os.path.abspath(db_file_path))
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            query = "SELECT DISTINCT contentnode_id FROM content_file WHERE preset IN ({})"
+            rows = self.conn.execute(
+                query.format(", ".join("?" for _ in self.VIDEO_PRESETS)),
+                self.VIDEO_PRESETS,
+            )
+            self.video_node_ids = frozenset(row[0] for row in rows)
+
+    def has_video_file(self, node_id):
+        return node_id in self.video_node_ids
+
+    def get_assessment_metadata(self, node_id):
+        """
+        Returns a dict with the `assessment_item_ids` (list) and `mastery_model`
+        (JSON str) of the exercise `node_id`, or None if not in the channel.
+        """
+        if self.conn is None:
+            return None
+        row = self.conn.execute(
+            "SELECT assessment_item_ids, mastery_model "
+            "FROM content_assessmentmetadata WHERE contentnode_id = ?",
+            (node_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "assessment_item_ids": json.loads(row[0]),
+            "mastery_model": row[1],
+        }
+
+
+# Index of the videos in all the downloaded channel DBs
+VIDEO_REUSE_INDEX = os.path.join("chefdata", "videoreuse.sqlite3")
+
+# Version of the schema of the index (older indexes are rebuilt)
+VIDEO_REUSE_INDEX_VERSION = 2
+
+
+def get_user_version(db_path):
+    """
+    Returns the `user_version` of the sqlite database at `db_path` (0 if unset).
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def build_video_reuse_index(db_path=VIDEO_REUSE_INDEX, databases_dir=DATABASES_DIR):
+    """
+    Build the index of the high and low res video files of all the channel DBs
+    in `databases_dir`, keyed by the content_id, language, preset, and subtitle
+    languages of the video node. Since the content_id is computed from the
+    `source_domain` and the `source_id` (the youtube_id for KA videos), the same
+    video has the same content_id in all the KA channels. The subtitle languages
+    are part of the key because a reused node is imported with its subtitles.
+    """
+    tmp_path = "{}.{}.tmp".format(db_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(
+        """CREATE TABLE videos (
+            content_id TEXT NOT NULL,
+            lang_id TEXT,
+            preset TEXT NOT NULL,
+            channel_id TEXT NOT NULL,
+            node_id TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            subtitle_langs TEXT NOT NULL,
+            PRIMARY KEY (content_id, lang_id, preset, subtitle_langs, channel_id)
+        ) WITHOUT ROWID"""
+    )
+    conn.execute("PRAGMA user_version = {}".format(VIDEO_REUSE_INDEX_VERSION))
+    presets = RemoteNodesIndex.VIDEO_PRESETS
+    # Comma-separated sorted subtitle languages of each node of the attached DB
+    subtitles_query = """CREATE TEMP TABLE subtitles AS
+        SELECT contentnode_id, group_concat(lang_id, ',') AS langs FROM (
+            SELECT DISTINCT contentnode_id, lang_id FROM src.content_file
+            WHERE preset = ? ORDER BY contentnode_id, lang_id
+        ) GROUP BY contentnode_id"""
+    query = """INSERT OR IGNORE INTO videos
+        SELECT n.content_id, n.lang_id, f.preset, n.channel_id, n.id, f.local_file_id,
+            COALESCE(s.langs, '')
+        FROM src.content_file f JOIN src.content_contentnode n ON n.id = f.contentnode_id
+        LEFT JOIN temp.subtitles s ON s.contentnode_id = n.id
+        WHERE f.preset IN ({})""".format(", ".join("?" for _ in presets))
+    for filename in sorted(os.listdir(databases_dir)):
+        if not filename.endswith(".sqlite3"):
+            continue
+        try:
+            conn.execute(
+                "ATTACH DATABASE ? AS src", (os.path.join(databases_dir, filename),)
+            )
+        except sqlite3.DatabaseError as e:
+            print("Skipping channel DB", filename, e)
+            continue
+        try:
+            conn.execute(subtitles_query, (format_presets.VIDEO_SUBTITLE,))
+            conn.execute(query, presets)
+            conn.commit()
+        except sqlite3.DatabaseError as e:
+            print("Skipping channel DB", filename, e)
+        finally:
+            conn.execute("DROP TABLE IF EXISTS temp.subtitles")
+            conn.execute("DETACH DATABASE src")
+    conn.close()
+    os.replace(tmp_path, db_path)
+
+
+class VideoReuseIndex:
+    """
+    Lookups of videos that are already on Studio in any of the channels whose DB
+    was downloaded to `databases_dir`. The index is rebuilt when a channel DB is
+    newer than the index, or when it has an older schema.
+    """
+
+    def __init__(self, db_path=VIDEO_REUSE_INDEX, databases_dir=DATABASES_DIR):
+        os.makedirs(databases_dir, exist_ok=True)
+        db_mtimes = [
+            os.path.getmtime(os.path.join(databases_dir, filename))
+            for filename in os.listdir(databases_dir)
+            if filename.endswith(".sqlite3")
+        ]
+        if (
+            not os.path.exists(db_path)
+            or os.path.getmtime(db_path) < max(db_mtimes, default=0)
+            or get_user_version(db_path) != VIDEO_REUSE_INDEX_VERSION
+        ):
+            build_video_reuse_index(db_path=db_path, databases_dir=databases_dir)
+        uri = "file:{}?mode=ro".format(os.path.abspath(db_path))
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def find(
+        self, content_id, lang_id, preset, subtitle_langs=(), exclude_channel_id=None
+    ):
+        """
+        Returns a tuple (channel_id, node_id, checksum) for a node with a video
+        file for `content_id` in `lang_id` with `preset`, and subtitle files in
+        exactly the languages `subtitle_langs`, or None if not found.
+        """
+        row = self.conn.execute(
+            "SELECT channel_id, node_id, checksum FROM videos "
+            "WHERE content_id = ? AND lang_id = ? AND preset = ? "
+            "AND subtitle_langs = ? AND channel_id != ? "
+            "ORDER BY channel_id LIMIT 1",
+            (
+                content_id,
+                lang_id,
+                preset,
+                ",".join(sorted(set(subtitle_langs))),
+                exclude_channel_id or "",
+            ),
+        ).fetchone()
+        return tuple(row) if row else None
+
+
 def get_nodes_for_remote_files(channel_id):
+    """
+    Returns the RemoteNodesIndex for the published channel `channel_id`, which is
+    empty if the channel's DB file can't be downloaded or read.
+    """
     try:
         db_file_path = download_db_file(channel_id)
-        conn = sqlite3.connect(db_file_path)
-        return get_nodes_by_id(conn, attach_files=True, attach_assessments=False)
+        return RemoteNodesIndex(db_file_path)
     except Exception:
-        return {}
+        return RemoteNodesIndex()
 
 
 def get_files(conn):
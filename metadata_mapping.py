@@ -0,0 +1,87 @@
+"""
+Indexed on-disk store for the metadata mapping {slug --> {grade_levels, categories}}
+that is generated from the English TSV data (see `generate_metadata_mapping` in
+tsvkhan.py) and used to set the metadata of resources in all the other channels.
+
+The mapping is stored in a sqlite database with the slug as primary key, so each
+chef process only reads the rows it needs instead of loading the whole mapping.
+"""
+from functools import lru_cache
+import json
+import os
+import sqlite3
+import threading
+
+
+METADATA_MAPPING_DB = os.path.join("chefdata", "metadata_mapping.sqlite3")
+
+METADATA_LOOKUP_CACHE_SIZE = 8192
+
+
+def write_metadata_mapping(metadata_mapping, db_path=METADATA_MAPPING_DB):
+    """
+    Save the dict `metadata_mapping` to a new sqlite database at `db_path`.
+    The database is written to a temporary file first and then moved in place,
+    so that chef processes that are reading the old mapping are not affected.
+    """
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(
+        "CREATE TABLE metadata (slug TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID"
+    )
+    conn.executemany(
+        "INSERT INTO metadata (slug, data) VALUES (?, ?)",
+        (
+            (slug, json.dumps(metadata))
+            for slug, metadata in sorted(metadata_mapping.items())
+        ),
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, db_path)
+
+
+class MetadataMappingStore:
+    """
+    Read-only access to the metadata mapping in `db_path` with an LRU cache in
+    front of the per-slug lookups. Connections are opened lazily per thread and
+    per process, so the store can be shared by threads and by forked processes.
+    """
+
+    def __init__(
+        self, db_path=METADATA_MAPPING_DB, cache_size=METADATA_LOOKUP_CACHE_SIZE
+    ):
+        if not os.path.exists(db_path):
+            raise IOError("Metadata mapping database not found " + db_path)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._get_data = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def _get_connection(self):
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            uri = "file:{}?mode=ro".format(os.path.abspath(self.db_path))
+            self._local.conn = sqlite3.connect(uri, uri=True)
+            self._local.pid = pid
+        return self._local.conn
+
+    def _lookup(self, slug):
+        row = (
+            self._get_connection()
+            .execute("SELECT data FROM metadata WHERE slug = ?", (slug,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def get(self, slug):
+        """
+        Returns a new dict with the metadata for `slug` ({} if not in the mapping).
+        """
+        data = self._get_data(slug)
+        return json.loads(data) if data else {}
+
+    def __len__(self):
+        query = "SELECT COUNT(*) FROM metadata"
+        return self._get_connection().execute(query).fetchone()[0]
@@ -1,8 +1,19 @@
+import atexit
+from collections import deque
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+from email.utils import parsedate_to_datetime
 import hashlib
 import json
 import os
+import random
 import requests
+import sqlite3
+import threading
 import time
+from urllib.parse import urlparse
 
 from pycaption import CaptionNode
 from pycaption import Caption
@@ -41,43 +52,62 @@ headers = {
 }
 
 
-class Dummy404ResponseObject(requests.Response):
-    def __init__(self, url):
-        super(Dummy404ResponseObject, self).__init__()
-        self._content = b""
-        self.status_code = 404
-        self.url = url
+class RequestFailedError(requests.exceptions.ConnectionError):
+    """
+    Raised when a request failed after all the retries of the RetryPolicy, or
+    was not sent because the circuit breaker of the host stayed open.
+    """
 
 
-def make_request(url, clear_cookies=True, timeout=60, *args, **kwargs):
-    if clear_cookies:
-        sess.cookies.clear()
-
-    retry_count_500 = 0
+def _send_with_retries(url, send):
+    """
+    Call `send()`, which returns the response of one request to `url`, retrying
+    connection errors, timeouts, and the RETRY_STATUS_CODES responses as set by
+    `retry_policy`, after waiting for the circuit breaker of the host to close.
+    The response of the last retry is returned if the server kept replying with
+    an error status.
+    Raises RequestFailedError if the server could not be reached.
+    """
+    breaker = get_circuit_breaker(url)
     retry_count = 0
-    max_retries = 5
     while True:
+        trial = retry_policy.wait_for_circuit(url, breaker)
+        status_code, retry_after, error = None, None, None
         try:
-            response = sess.get(url, headers=headers, timeout=timeout, *args, **kwargs)
-            retry_count_500 += 1
-            if response.status_code == 500:
-                time.sleep(retry_count_500 * 1)
-                continue
-            if retry_count_500 >= max_retries:
-                break
-        except (
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ReadTimeout,
-        ) as e:
-            retry_count += 1
-            print(
-                "Error with connection ('{msg}'); about to perform retry {count} of {trymax}.".format(
-                    msg=str(e), count=retry_count, trymax=max_retries
-                )
-            )
-            time.sleep(retry_count * 1)
-            if retry_count >= max_retries:
-                return Dummy404ResponseObject(url=url)
+            response = send()
+            status_code = response.status_code
+            if status_code in RETRY_STATUS_CODES:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except RETRY_EXCEPTIONS as e:
+            error = e
+        except Exception:
+            breaker.record(False, trial)
+            raise
+        breaker.record(status_code is not None and status_code < 500, trial)
+        if error is None and status_code not in RETRY_STATUS_CODES:
+            return response
+        if retry_count >= retry_policy.max_retries:
+            retry_policy.count("failures")
+            if error is None:
+                return response
+            raise RequestFailedError("Failed to request {}: {}".format(url, error))
+        retry_count += 1
+        retry_policy.wait(url, retry_count, error or status_code, retry_after)
+
+
+def make_request(url, clear_cookies=True, timeout=60, *args, **kwargs):
+    """
+    GET `url` and return the response, with the retries of `_send_with_retries`.
+    Raises RequestFailedError if the server could not be reached.
+    """
+    session = get_session()
+    if clear_cookies:
+        session.cookies.clear()
+
+    response = _send_with_retries(
+        url,
+        lambda: session.get(url, headers=headers, timeout=timeout, *args, **kwargs),
+    )
 
     if response.status_code != 200:
         print("NOT FOUND:", url)
@@ -87,33 +117,509 @@ def make_request(url, clear_cookies=True, timeout=60, *args, **kwargs):
     return response
 
 
+def head_request(url, timeout=30):
+    """
+    Check that the file at `url` is available without downloading it, using a
+    HEAD request, or a GET request for the first byte when HEAD is not allowed,
+    with the retries of `_send_with_retries`.
+    Returns: tuple (status_code, size in bytes or None), with status_code None
+    if the server could not be reached.
+    """
+    session = get_session()
+
+    def send():
+        response = session.head(
+            url, headers=headers, timeout=timeout, allow_redirects=True
+        )
+        if response.status_code in [403, 405, 501]:
+            range_headers = dict(headers, Range="bytes=0-0")
+            response = session.get(
+                url, headers=range_headers, timeout=timeout, stream=True
+            )
+            response.close()
+        return response
+
+    try:
+        response = _send_with_retries(url, send)
+    except RequestFailedError as e:
+        LOGGER.warning(str(e))
+        return None, None
+    size = None
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code == 206 and "/" in content_range:
+        size = content_range.rsplit("/", 1)[1]
+    elif response.status_code == 200:
+        size = response.headers.get("Content-Length")
+    status_code = 200 if response.status_code == 206 else response.status_code
+    return status_code, int(size) if size and size.isdigit() else None
+
+
+# ADAPTIVE CONCURRENCY
+################################################################################
+
+# Concurrent POST requests per host: start value and bounds of the adaptive limit
+INITIAL_CONCURRENCY_LIMIT = 4
+MIN_CONCURRENCY_LIMIT = 1
+MAX_CONCURRENCY_LIMIT = 16
+
+# Requests slower than this (in seconds) are treated like errors
+LATENCY_THRESHOLD = 10
+
+# Multiply the limit by this factor on errors, throttling, and slow requests
+LIMIT_DECREASE_FACTOR = 0.5
+
+# Longest wait accepted from a Retry-After header (in seconds)
+MAX_RETRY_AFTER = 300
+
+# Throughput is measured over this many seconds
+THROUGHPUT_WINDOW = 60
+
+# Number of hosts whose connection pools are kept by each adapter
+POOL_CONNECTIONS = 32
+
+# Keep enough pooled connections to each host for the concurrent requests of
+# the prefetchers and caches
+POOL_MAXSIZE = 32
+
+pool_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+)
+sess.mount("https://", pool_adapter)
+sess.mount("http://", pool_adapter)
+for adapter in [forever_adapter, invalidate_adapter]:
+    adapter.init_poolmanager(POOL_CONNECTIONS, POOL_MAXSIZE)
+
+# The concurrent requests of the chef are made by the thread pools of the
+# prefetchers and caches (with the sessions of `get_session`), rather than by an
+# asyncio client: the GET requests go through the requests-cache adapters of
+# `sess`, and the POST requests through the AdaptiveConcurrencyLimiter, which
+# are both blocking. HTTP/2 is not used since requests doesn't support it.
+thread_sessions = threading.local()
+
+
+def get_session():
+    """
+    Returns the requests session of the current thread. The sessions of all the
+    threads share the adapters of `sess`, and so their connection pools (with
+    keep-alive connections) and caches, but each session has its own cookies, so
+    `clear_cookies` doesn't affect the requests of other threads.
+    """
+    session = getattr(thread_sessions, "session", None)
+    if session is None:
+        if threading.current_thread() is threading.main_thread():
+            session = sess
+        else:
+            session = requests.Session()
+            session.adapters = sess.adapters
+        thread_sessions.session = session
+    return session
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds to wait for the Retry-After header `value`,
+    which can be a number of seconds or an HTTP date, or None if not valid.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) limit on the number of
+    concurrent requests to one host. The limit grows by about one request per
+    round trip while requests succeed within `latency_threshold` seconds, and is
+    halved on 429/5xx responses, connection errors, and slow requests. A single
+    decrease is applied for all the requests that were in flight at the time.
+    After a response with a Retry-After header, no new requests are started
+    until the requested time has passed.
+    """
+
+    def __init__(
+        self,
+        initial_limit=INITIAL_CONCURRENCY_LIMIT,
+        min_limit=MIN_CONCURRENCY_LIMIT,
+        max_limit=MAX_CONCURRENCY_LIMIT,
+        latency_threshold=LATENCY_THRESHOLD,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.completed = deque()  # completion times within THROUGHPUT_WINDOW
+        self.counters = {"requests": 0, "errors": 0, "throttled": 0, "slow": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a request slot. Returns the start time of the request.
+        """
+        with self.condition:
+            while True:
+                wait_time = self.blocked_until - time.time()
+                if wait_time <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(timeout=wait_time if wait_time > 0 else None)
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, start_time, status_code=None, retry_after=None):
+        """
+        Release the slot of the request started at `start_time` (returned by
+        `acquire`), and adjust the limit based on the response `status_code`
+        (None for connection errors) and the `retry_after` seconds requested.
+        """
+        now = time.time()
+        throttled = status_code == 429 or retry_after is not None
+        failed = status_code is None or status_code >= 500
+        slow = now - start_time > self.latency_threshold
+        with self.condition:
+            self.in_flight -= 1
+            self.counters["requests"] += 1
+            if throttled or failed or slow:
+                if throttled:
+                    self.counters["throttled"] += 1
+                elif failed:
+                    self.counters["errors"] += 1
+                else:
+                    self.counters["slow"] += 1
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                if start_time > self.last_decrease:
+                    self.limit = max(
+                        self.min_limit, self.limit * LIMIT_DECREASE_FACTOR
+                    )
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.completed.append(now)
+            while self.completed and self.completed[0] < now - THROUGHPUT_WINDOW:
+                self.completed.popleft()
+            self.condition.notify_all()
+
+    def get_metrics(self):
+        """
+        Returns a dict with the current limit, the requests in flight, the
+        throughput of successful requests (per second), and the counters.
+        """
+        with self.condition:
+            now = time.time()
+            while self.completed and self.completed[0] < now - THROUGHPUT_WINDOW:
+                self.completed.popleft()
+            metrics = dict(self.counters)
+            metrics["limit"] = int(self.limit)
+            metrics["in_flight"] = self.in_flight
+            metrics["throughput"] = len(self.completed) / THROUGHPUT_WINDOW
+        return metrics
+
+
+concurrency_limiters = {}  # {host --> AdaptiveConcurrencyLimiter}
+concurrency_limiters_lock = threading.Lock()
+
+
+def get_concurrency_limiter(url):
+    """
+    Returns the AdaptiveConcurrencyLimiter for the host of `url`.
+    """
+    host = urlparse(url).netloc
+    with concurrency_limiters_lock:
+        if host not in concurrency_limiters:
+            concurrency_limiters[host] = AdaptiveConcurrencyLimiter()
+        return concurrency_limiters[host]
+
+
+# RETRY POLICY
+################################################################################
+
+# Number of times a failed request is retried
+MAX_RETRIES = 5
+
+# The delay before retry n is drawn uniformly from [0, BACKOFF_BASE * 2 ** (n - 1)]
+BACKOFF_BASE = 1
+
+# Longest delay between retries (in seconds), except for Retry-After headers
+BACKOFF_MAX = 60
+
+# Responses with these status codes are retried
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Errors of requests that are retried
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+# Open the circuit of a host after this many consecutive failed requests
+CIRCUIT_FAILURE_THRESHOLD = 10
+
+# Requests to a host are held back for this many seconds after its circuit opens
+CIRCUIT_RESET_TIMEOUT = 60
+
+# Requests wait at most this many seconds in total for an open circuit to close
+CIRCUIT_MAX_WAIT = 600
+
+# Interval (in seconds) between checks of the circuit while its trial is in flight
+CIRCUIT_TRIAL_POLL_INTERVAL = 1
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter between the retries of failed requests,
+    which spreads the retries of concurrent requests over time. The delay
+    requested by a Retry-After header is used instead when there is one. Requests
+    to a host whose circuit is open wait for it to close, for at most
+    `max_circuit_wait` seconds. Counts the retries, the failed requests, the
+    requests rejected after waiting for an open circuit, and the time spent
+    sleeping.
+    """
+
+    def __init__(
+        self,
+        max_retries=MAX_RETRIES,
+        base_delay=BACKOFF_BASE,
+        max_delay=BACKOFF_MAX,
+        max_circuit_wait=CIRCUIT_MAX_WAIT,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_circuit_wait = max_circuit_wait
+        self.lock = threading.Lock()
+        self.counters = {"retries": 0, "failures": 0, "rejected": 0, "sleep_seconds": 0}
+
+    def get_delay(self, retry_count, retry_after=None):
+        """
+        Returns the number of seconds to wait before the retry `retry_count`.
+        """
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (retry_count - 1))
+        )
+
+    def wait(self, url, retry_count, reason, retry_after=None):
+        """
+        Sleep before the retry `retry_count` of the request to `url`, which failed
+        because of `reason` (an exception or a status code).
+        """
+        delay = self.get_delay(retry_count, retry_after)
+        LOGGER.warning(
+            "Error with {} ({}); retry {} of {} in {:.1f}s".format(
+                url, reason, retry_count, self.max_retries, delay
+            )
+        )
+        with self.lock:
+            self.counters["retries"] += 1
+            self.counters["sleep_seconds"] += delay
+        time.sleep(delay)
+
+    def wait_for_circuit(self, url, breaker):
+        """
+        Sleep until the CircuitBreaker `breaker` allows a request to `url`.
+        Returns True if the request is the trial request of the breaker.
+        Raises RequestFailedError if the circuit stayed open `max_circuit_wait`
+        seconds.
+        """
+        waited = 0
+        while True:
+            delay, trial = breaker.allow()
+            if not delay:
+                return trial
+            if waited >= self.max_circuit_wait:
+                self.count("rejected")
+                raise RequestFailedError("Circuit breaker open for " + url)
+            delay = min(delay, self.max_circuit_wait - waited)
+            if not waited:
+                LOGGER.warning(
+                    "Circuit breaker open for {}; waiting {:.1f}s".format(url, delay)
+                )
+            with self.lock:
+                self.counters["sleep_seconds"] += delay
+            time.sleep(delay)
+            waited += delay
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the requests to one host. After `failure_threshold`
+    consecutive failed requests (connection errors and 5xx responses) the circuit
+    opens, and requests are not sent for `reset_timeout` seconds. Then a single
+    trial request is sent: the circuit closes if it succeeds, and opens again if
+    it fails. The results of requests that were sent before the circuit opened
+    are ignored while it is open.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns a tuple (delay, trial) where `delay` is the number of seconds to
+        wait before asking again (0 if a request can be sent now), and `trial` is
+        True if the request is the trial request of the open circuit.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0, False
+            remaining = self.opened_at + self.reset_timeout - time.time()
+            if remaining > 0:
+                return remaining, False
+            if self.trial_in_flight:
+                return CIRCUIT_TRIAL_POLL_INTERVAL, False
+            self.trial_in_flight = True
+            return 0, True
+
+    def record(self, success, trial=False):
+        """
+        Record the result of a request that was allowed by `allow`, with the
+        `trial` value returned by `allow`.
+        """
+        with self.lock:
+            if trial:
+                self.trial_in_flight = False
+                if success:
+                    self.failures = 0
+                    self.opened_at = None
+                else:
+                    self.opened_at = time.time()
+                    self.times_opened += 1
+                return
+            if self.opened_at is not None:
+                return
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                LOGGER.warning("Too many failed requests; opening circuit")
+                self.opened_at = time.time()
+                self.times_opened += 1
+
+
+retry_policy = RetryPolicy()
+
+circuit_breakers = {}  # {host --> CircuitBreaker}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url):
+    """
+    Returns the CircuitBreaker for the host of `url`.
+    """
+    host = urlparse(url).netloc
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker()
+        return circuit_breakers[host]
+
+
+def get_retry_metrics():
+    """
+    Returns a dict with the counters of `retry_policy`, and `circuits_opened`,
+    the number of times the circuit of each host {host --> count} was opened.
+    """
+    metrics = retry_policy.get_metrics()
+    with circuit_breakers_lock:
+        metrics["circuits_opened"] = dict(
+            (host, breaker.times_opened)
+            for host, breaker in circuit_breakers.items()
+            if breaker.times_opened
+        )
+    return metrics
+
+
+def log_retry_metrics():
+    metrics = get_retry_metrics()
+    if metrics["retries"] or metrics["failures"] or metrics["rejected"]:
+        LOGGER.info(
+            "HTTP retries: {retries} retries, {failures} failed requests, "
+            "{rejected} rejected by circuits open too long {circuits_opened}, "
+            "{sleep_seconds:.0f}s sleeping".format(**metrics)
+        )
+
+
+atexit.register(log_retry_metrics)
+
+
 def post_request(url, data, clear_cookies=True, timeout=60, *args, **kwargs):
+    """
+    POST the JSON `data` to `url` and return the JSON response. Connection errors,
+    timeouts, and RETRY_STATUS_CODES responses are retried as set by
+    `retry_policy`. The number of concurrent requests to each host is limited by
+    its AdaptiveConcurrencyLimiter, which also enforces the wait requested by
+    Retry-After headers.
+    Raises RequestFailedError if the request failed.
+    """
+    session = get_session()
     if clear_cookies:
-        sess.cookies.clear()
+        session.cookies.clear()
 
+    limiter = get_concurrency_limiter(url)
+    breaker = get_circuit_breaker(url)
     retry_count = 0
-    max_retries = 5
     while True:
+        trial = retry_policy.wait_for_circuit(url, breaker)
+        start_time = limiter.acquire()
+        status_code, retry_after, error = None, None, None
         try:
-            response = sess.post(
+            response = session.post(
                 url, json=data, headers=headers, timeout=timeout, *args, **kwargs
             )
+            status_code = response.status_code
+            if status_code in RETRY_STATUS_CODES:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
             response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            error = e
+        except RETRY_EXCEPTIONS as e:
+            error = e
+        except Exception:
+            breaker.record(False, trial)
+            raise
+        finally:
+            limiter.release(start_time, status_code, retry_after)
+        breaker.record(status_code is not None and status_code < 500, trial)
+        if error is None:
             break
-        except (
-            requests.exceptions.HTTPError,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ReadTimeout,
-        ) as e:
-            retry_count += 1
-            print(
-                "Error with connection ('{msg}'); about to perform retry {count} of {trymax}.".format(
-                    msg=str(e), count=retry_count, trymax=max_retries
-                )
-            )
-            time.sleep(retry_count * 1)
-            if retry_count >= max_retries:
-                return None
+        if status_code is not None and status_code not in RETRY_STATUS_CODES:
+            retry_policy.count("failures")
+            raise RequestFailedError("Failed to POST {}: {}".format(url, error))
+        if retry_count >= retry_policy.max_retries:
+            retry_policy.count("failures")
+            raise RequestFailedError("Failed to POST {}: {}".format(url, error))
+        retry_count += 1
+        # The limiter makes the next acquire wait for the Retry-After time
+        retry_policy.wait(url, retry_count, error, 0 if retry_after else None)
     return response.json()
 
 
@@ -129,59 +635,290 @@ query LearningEquality_getSubtitles($youtubeId: String!, $kaLocale: String) {
 """
 
 SUBTITLE_LANGUAGES_CACHE_INDEX = os.path.join(
+    SUBTITLE_LANGUAGES_CACHE_DIR, "index.sqlite3"
+)
+
+# Index in the JSON format used previously, converted if found
+SUBTITLE_LANGUAGES_CACHE_JSON_INDEX = os.path.join(
     SUBTITLE_LANGUAGES_CACHE_DIR, "index.json"
 )
 
+AMARA_VIDEOS_URL = "https://amara.org/api/videos/?team=khan-academy&limit={limit}&offset={offset}&format=json"
+AMARA_VIDEO_URL = "https://amara.org/api/videos/{video_id}/?format=json"
+AMARA_ACTIVITY_URL = "https://amara.org/api/teams/khan-academy/activity/?type=version-added&after={after}&limit=100&format=json"
+AMARA_PAGE_SIZE = 100
+
+# Number of Amara API pages (or videos) that are fetched concurrently
+SUBTITLE_CRAWL_WORKERS = 8
 
-def _populate_sublangscache_index():
-    LOGGER.info(
-        "Populating subtitle language cache index to create complete listing of all subtitles for all KA Youtube videos"
+# The index is refreshed with the changes on Amara when older than this
+SUBTITLE_INDEX_MAX_AGE_DAYS = 7
+
+
+def _get_amara_youtube_id(video):
+    """
+    Returns the youtube_id of the `video` from the Amara videos API.
+    """
+    return video["all_urls"][0].replace("http://www.youtube.com/watch?v=", "")
+
+
+def _get_amara_subtitle_rows(videos):
+    """
+    Returns the (youtube_id, lang, url) rows for the published subtitles of the
+    `videos` from the Amara videos API.
+    """
+    rows = []
+    for video in videos:
+        youtube_id = _get_amara_youtube_id(video)
+        for subtitle in video["languages"]:
+            if subtitle.get("published", False):
+                url = subtitle["subtitles_uri"].replace("format=json", "format=vtt")
+                rows.append((youtube_id, subtitle["code"], url))
+    return rows
+
+
+def _create_sublangscache_index(db_path):
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS subtitles (
+            youtube_id TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (youtube_id, lang)
+        ) WITHOUT ROWID"""
     )
-    url = "https://amara.org/api/videos/?team=khan-academy&limit=100&format=json"
-    LOGGER.info("Fetching and processing {}".format(url))
-    response = make_request(url)
-    if response.status_code == 200:
-        index = {}
-        data = response.json()
-        while data:
-            for video in data["objects"]:
-                youtube_id = video["all_urls"][0].replace(
-                    "http://www.youtube.com/watch?v=", ""
-                )
-                published_subtitles = []
-                for subtitle in video["languages"]:
-                    if subtitle.get("published", False):
-                        published_subtitles.append(
-                            {
-                                "lang": subtitle["code"],
-                                "url": subtitle["subtitles_uri"].replace(
-                                    "format=json", "format=vtt"
-                                ),
-                            }
-                        )
-                index[youtube_id] = published_subtitles
-            url = data["meta"]["next"]
-            if url:
-                LOGGER.info("Fetching and processing {}".format(url))
-                response = make_request(url)
-                data = response.json()
-            else:
-                data = None
+    conn.execute("CREATE TABLE IF NOT EXISTS crawl (crawled_at REAL NOT NULL)")
+    return conn
+
+
+def _save_subtitle_rows(conn, rows, replace_youtube_ids=()):
+    """
+    Save the subtitle `rows`, after deleting all the rows of the videos in
+    `replace_youtube_ids` (which can have no published subtitles left).
+    """
+    with conn:
+        conn.executemany(
+            "DELETE FROM subtitles WHERE youtube_id = ?",
+            [(youtube_id,) for youtube_id in set(replace_youtube_ids)],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO subtitles (youtube_id, lang, url) VALUES (?, ?, ?)",
+            rows,
+        )
+
+
+def _set_crawled_at(conn, crawled_at):
+    with conn:
+        conn.execute("DELETE FROM crawl")
+        conn.execute("INSERT INTO crawl (crawled_at) VALUES (?)", (crawled_at,))
+
+
+def get_sublangscache_index_age(db_path=SUBTITLE_LANGUAGES_CACHE_INDEX):
+    """
+    Returns the number of seconds since the last crawl of the index in `db_path`,
+    or None if the index doesn't exist or doesn't record its crawl time.
+    """
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        row = conn.execute("SELECT crawled_at FROM crawl").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    return time.time() - row[0] if row else None
+
+
+def _fetch_json(url):
+    try:
+        response = make_request(url)
+    except RequestFailedError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def _populate_sublangscache_index(db_path=SUBTITLE_LANGUAGES_CACHE_INDEX):
+    """
+    Crawl the complete listing of the subtitles of KA videos on Amara, fetching
+    up to SUBTITLE_CRAWL_WORKERS pages concurrently. The pages are saved as they
+    arrive in a temporary database, which is moved in place at the end, so that
+    chef processes that are reading the old index are not affected. The crawl is
+    aborted if any page fails, since the videos of the page would be missing
+    from the index until it expires.
+    """
+    tmp_path = "{}.{}.tmp".format(db_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = _create_sublangscache_index(tmp_path)
+    crawled_at = time.time()
+
+    if os.path.exists(SUBTITLE_LANGUAGES_CACHE_JSON_INDEX):
+        LOGGER.info("Converting subtitle language cache index.json to sqlite")
+        with open(SUBTITLE_LANGUAGES_CACHE_JSON_INDEX, "r") as f:
+            index = json.load(f)
+        rows = [
+            (youtube_id, sub["lang"], sub["url"])
+            for youtube_id, subs in index.items()
+            for sub in subs
+        ]
+        _save_subtitle_rows(conn, rows)
+        # Refresh with the changes since the JSON index was written
+        crawled_at = os.path.getmtime(SUBTITLE_LANGUAGES_CACHE_JSON_INDEX)
+    else:
+        LOGGER.info(
+            "Populating subtitle language cache index to create complete listing of all subtitles for all KA Youtube videos"
+        )
+        url = AMARA_VIDEOS_URL.format(limit=AMARA_PAGE_SIZE, offset=0)
+        LOGGER.info("Fetching and processing {}".format(url))
+        data = _fetch_json(url)
+        if data is None:
+            conn.close()
+            os.remove(tmp_path)
+            raise ConnectionError("Failed to fetch Amara videos listing " + url)
+        _save_subtitle_rows(conn, _get_amara_subtitle_rows(data["objects"]))
+        urls = [
+            AMARA_VIDEOS_URL.format(limit=AMARA_PAGE_SIZE, offset=offset)
+            for offset in range(
+                AMARA_PAGE_SIZE, data["meta"]["total_count"], AMARA_PAGE_SIZE
+            )
+        ]
+        failed_urls = []
+        with ThreadPoolExecutor(max_workers=SUBTITLE_CRAWL_WORKERS) as executor:
+            futures = dict((executor.submit(_fetch_json, url), url) for url in urls)
+            for i, future in enumerate(as_completed(futures)):
+                data = future.result()
+                if data is None:
+                    LOGGER.warning("Failed to fetch Amara page " + futures[future])
+                    failed_urls.append(futures[future])
+                    continue
+                _save_subtitle_rows(conn, _get_amara_subtitle_rows(data["objects"]))
+                if (i + 1) % 100 == 0:
+                    LOGGER.info("Fetched {} of {} Amara pages".format(i + 1, len(urls)))
+        if failed_urls:
+            conn.close()
+            os.remove(tmp_path)
+            raise ConnectionError(
+                "Failed to fetch {} Amara videos listing pages".format(len(failed_urls))
+            )
+
+    _set_crawled_at(conn, crawled_at)
+    conn.close()
     LOGGER.info("Writing subtitles language cache to disk")
-    with open(SUBTITLE_LANGUAGES_CACHE_INDEX, "w") as f:
-        json.dump(index, f)
+    os.replace(tmp_path, db_path)
+    if crawled_at < time.time() - 60:
+        _refresh_sublangscache_index(db_path)
+
+
+def _fetch_amara_video(url):
+    """
+    Returns the data of the Amara video at `url`, an empty dict if the video
+    was deleted, or None if the request failed.
+    """
+    try:
+        response = make_request(url)
+    except RequestFailedError:
+        return None
+    if response.status_code in [404, 410]:
+        return {}
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def _refresh_sublangscache_index(db_path=SUBTITLE_LANGUAGES_CACHE_INDEX):
+    """
+    Update the index in `db_path` with the videos whose subtitles were changed
+    on Amara since the last crawl, as listed by the team activity API. The crawl
+    time of the index is only moved forward if all the videos were fetched, so
+    that the failed videos are fetched again by the next refresh.
+    """
+    conn = _create_sublangscache_index(db_path)
+    row = conn.execute("SELECT crawled_at FROM crawl").fetchone()
+    started_at = time.time()
+    after = datetime.fromtimestamp(row[0] if row else 0, timezone.utc)
+    url = AMARA_ACTIVITY_URL.format(after=after.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    LOGGER.info("Refreshing subtitle language cache index from {}".format(url))
+    video_ids = set()
+    while url:
+        data = _fetch_json(url)
+        if data is None:
+            LOGGER.warning("Failed to fetch Amara activity; index not refreshed")
+            conn.close()
+            return
+        video_ids.update(record["video"] for record in data["objects"])
+        url = data["meta"]["next"]
+    LOGGER.info("Fetching {} videos with changed subtitles".format(len(video_ids)))
+    failed = 0
+    with ThreadPoolExecutor(max_workers=SUBTITLE_CRAWL_WORKERS) as executor:
+        urls = [AMARA_VIDEO_URL.format(video_id=video_id) for video_id in video_ids]
+        for url, video in zip(urls, executor.map(_fetch_amara_video, urls)):
+            if video is None:
+                LOGGER.warning("Failed to fetch Amara video " + url)
+                failed += 1
+            elif video:
+                rows = _get_amara_subtitle_rows([video])
+                _save_subtitle_rows(
+                    conn, rows, replace_youtube_ids=[_get_amara_youtube_id(video)]
+                )
+    if failed:
+        LOGGER.warning(
+            "Failed to fetch {} Amara videos; they are fetched again next run".format(
+                failed
+            )
+        )
+    else:
+        _set_crawled_at(conn, started_at)
+    conn.close()
+
+
+class SubtitleLanguagesIndex:
+    """
+    Read-only access to the subtitle language cache index in `db_path`.
+    Connections are opened lazily per thread and per process, so the index can
+    be shared by threads and by concurrent chef processes.
+    """
+
+    def __init__(self, db_path=SUBTITLE_LANGUAGES_CACHE_INDEX):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _get_connection(self):
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            uri = "file:{}?mode=ro".format(os.path.abspath(self.db_path))
+            self._local.conn = sqlite3.connect(uri, uri=True)
+            self._local.pid = pid
+        return self._local.conn
+
+    def get(self, youtube_id):
+        """
+        Returns the list of (lang, url) of the subtitles for `youtube_id`.
+        """
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT lang, url FROM subtitles WHERE youtube_id = ? ORDER BY lang",
+                (youtube_id,),
+            )
+            .fetchall()
+        )
 
 
-subtitle_language_cache = {}
+subtitle_languages_index = None
+subtitle_languages_index_lock = threading.Lock()
 
 
 def get_subtitles(youtube_id):
-    if not subtitle_language_cache:
-        if not os.path.exists(SUBTITLE_LANGUAGES_CACHE_INDEX):
-            _populate_sublangscache_index()
-        with open(SUBTITLE_LANGUAGES_CACHE_INDEX, "r") as f:
-            data = json.load(f)
-            subtitle_language_cache.update(data)
-    return [
-        (sub["lang"], sub["url"]) for sub in subtitle_language_cache.get(youtube_id, [])
-    ]
+    global subtitle_languages_index
+    with subtitle_languages_index_lock:
+        if subtitle_languages_index is None:
+            index_age = get_sublangscache_index_age()
+            if index_age is None:
+                _populate_sublangscache_index()
+            elif index_age > SUBTITLE_INDEX_MAX_AGE_DAYS * 24 * 3600:
+                _refresh_sublangscache_index()
+            subtitle_languages_index = SubtitleLanguagesIndex()
+    return subtitle_languages_index.get(youtube_id)
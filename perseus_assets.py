@@ -0,0 +1,253 @@
+"""
+Prefetch the images used in the Perseus `itemData` of assessment items.
+
+The same graphie and image assets are used by many items, exercises, and language
+channels. The asset URLs of all fetched items are collected in a global index, and
+each unique asset is downloaded once by a pool of threads into the ricecooker
+storage directory (which is content-addressed), so that `PerseusQuestion`
+processing finds all its images in the ricecooker cache.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import sqlite3
+import threading
+
+from le_utils.constants import exercises
+from ricecooker import config
+
+# The same (private) file classes as PerseusQuestion, so that the downloaded
+# assets are found in the ricecooker cache. They are not part of the public API
+# of ricecooker, which is pinned in requirements.txt for this reason.
+from ricecooker.classes.files import _ExerciseGraphieFile
+from ricecooker.classes.files import _ExerciseImageFile
+from ricecooker.classes.questions import PERSEUS_MARKDOWN_IMAGE_REGEX
+from ricecooker.classes.questions import PERSEUS_QUOTED_IMAGE_REGEX
+from ricecooker.config import LOGGER
+
+
+# Index of the assets that were already downloaded {url --> (filename, size)}
+PERSEUS_ASSETS_DB = os.path.join("chefdata", "perseusassets.sqlite3")
+
+# Number of threads used to download the assets
+ASSET_WORKERS = 8
+
+# Log the asset counters every time this many assets are completed
+ASSET_LOG_INTERVAL = 500
+
+PERSEUS_IMAGE_REGEXES = [
+    re.compile(PERSEUS_QUOTED_IMAGE_REGEX),
+    re.compile(PERSEUS_MARKDOWN_IMAGE_REGEX),
+]
+
+
+def get_asset_urls(item_data):
+    """
+    Returns the list of (protocol, url) of the images in the Perseus `item_data`,
+    normalized the same way as in `PerseusQuestion._replace_image`. Inline data
+    and local files are skipped.
+    """
+    assets = []
+    for regex in PERSEUS_IMAGE_REGEXES:
+        for match in regex.finditer(item_data):
+            protocol, path = match.group("protocol"), match.group("rawpath")
+            if protocol not in ["web+graphie", "http", "https"]:
+                continue
+            if exercises.CONTENT_STORAGE_PLACEHOLDER in path:
+                continue
+            path = re.sub(r"\s", "", path).lstrip("\\n").rstrip("\\n")
+            url = "{}:{}".format(protocol.replace("web+graphie", "https"), path)
+            assets.append((protocol, url))
+    return assets
+
+
+class PerseusAssetPrefetcher:
+    """
+    Download the images used by assessment items in the background. Each call to
+    `add_items` extracts the asset URLs of the items and submits the assets that
+    were not seen before to a pool of `max_workers` threads. Assets that were
+    downloaded in a previous run (and are still in the ricecooker storage) are
+    counted as hits and are not downloaded again.
+    """
+
+    def __init__(
+        self,
+        ka_language,
+        db_path=PERSEUS_ASSETS_DB,
+        max_workers=ASSET_WORKERS,
+        log_interval=ASSET_LOG_INTERVAL,
+    ):
+        self.ka_language = ka_language
+        self.log_interval = log_interval
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="assetprefetch"
+        )
+        self.futures = {}  # {url --> Future}
+        self.item_urls = {}  # {item_id --> asset urls} of prefetched items
+        self.refs = {}  # {url --> number of references}
+        self.sizes = {}  # {url --> size in bytes}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "failed": 0, "downloaded_bytes": 0}
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS assets (
+                    url TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                ) WITHOUT ROWID"""
+            )
+
+    def add_items(self, items):
+        """
+        Queue the assets of the assessment `items` (list of item dicts) of one
+        exercise for download, and count the references to each asset.
+        Returns: list of Futures for the assets, resolved with their filename
+        (None if the download failed).
+        """
+        asset_urls = []
+        for item in items:
+            if item and item.get("itemData"):
+                asset_urls.extend(
+                    self._get_item_urls(item["id"], lambda: item["itemData"])
+                )
+        return self._submit_urls(asset_urls, count_refs=True)
+
+    def add_stored_items(self, item_store, exercise_id, item_ids):
+        """
+        Same as `add_items` for the items `item_ids` of the exercise `exercise_id`
+        that are in the AssessmentItemStore `item_store`. The item data is only
+        read from the store for the items that were not passed to `prefetch_items`,
+        one item at a time.
+        """
+        asset_urls = []
+        for item_id in item_ids:
+            asset_urls.extend(
+                self._get_item_urls(
+                    item_id, lambda: item_store.get_item_data(exercise_id, item_id)
+                )
+            )
+        return self._submit_urls(asset_urls, count_refs=True)
+
+    def prefetch_items(self, items):
+        """
+        Queue the assets of `items` for download without counting references,
+        for items that will be passed to `add_items` or `add_stored_items` later.
+        The asset URLs of each item are kept until then.
+        """
+        for item in items:
+            if not item or not item.get("itemData"):
+                continue
+            asset_urls = get_asset_urls(item["itemData"])
+            with self.lock:
+                self.item_urls[item["id"]] = asset_urls
+            self._submit_urls(asset_urls, count_refs=False)
+
+    def _get_item_urls(self, item_id, get_item_data):
+        """
+        Returns the asset URLs saved by `prefetch_items` for the item `item_id`,
+        or else the asset URLs of the item data returned by `get_item_data()`.
+        """
+        with self.lock:
+            asset_urls = self.item_urls.pop(item_id, None)
+        if asset_urls is None:
+            item_data = get_item_data()
+            asset_urls = get_asset_urls(item_data) if item_data else []
+        return asset_urls
+
+    def _submit_urls(self, asset_urls, count_refs):
+        futures = []
+        with self.lock:
+            for protocol, url in asset_urls:
+                if count_refs:
+                    self.refs[url] = self.refs.get(url, 0) + 1
+                if url not in self.futures:
+                    self.futures[url] = self.executor.submit(
+                        self._fetch_asset, protocol, url
+                    )
+                futures.append(self.futures[url])
+        return futures
+
+    def _get_indexed_asset(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename, size FROM assets WHERE url = ?", (url,)
+            ).fetchone()
+        if row and os.path.exists(config.get_storage_path(row[0])):
+            return row
+        return None
+
+    def _fetch_asset(self, protocol, url):
+        row = None if config.UPDATE else self._get_indexed_asset(url)
+        if row:
+            filename, size = row
+            counter = "hits"
+        else:
+            if protocol == "web+graphie":
+                asset_file = _ExerciseGraphieFile(url, self.ka_language)
+            else:
+                asset_file = _ExerciseImageFile(url)
+            filename = asset_file.process_file()
+            if filename:
+                size = os.path.getsize(config.get_storage_path(filename))
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO assets (url, filename, size) "
+                        "VALUES (?, ?, ?)",
+                        (url, filename, size),
+                    )
+                counter = "misses"
+            else:
+                # The failure is reported when the question is processed
+                if asset_file in config.FAILED_FILES:
+                    config.FAILED_FILES.remove(asset_file)
+                size = 0
+                counter = "failed"
+        with self.lock:
+            self.sizes[url] = size
+            self.counters[counter] += 1
+            if counter == "misses":
+                self.counters["downloaded_bytes"] += size
+            completed = self.counters["hits"] + self.counters["misses"]
+            completed += self.counters["failed"]
+            log_now = completed % self.log_interval == 0
+        if log_now:
+            self.log_counters()
+        return filename
+
+    def wait(self, futures):
+        """
+        Block until the assets `futures` (returned by `add_items`) are downloaded.
+        """
+        for future in futures:
+            future.exception()
+
+    def get_stats(self):
+        """
+        Returns a dict with the asset counters, the number of unique assets and
+        references, and `bytes_saved`: the number of bytes that would have been
+        downloaded without the deduplication and the index of previous downloads,
+        minus the bytes that were actually downloaded.
+        """
+        with self.lock:
+            total_bytes = sum(
+                self.sizes[url] * refs
+                for url, refs in self.refs.items()
+                if url in self.sizes
+            )
+            stats = dict(self.counters)
+            stats["unique"] = len(self.futures)
+            stats["references"] = sum(self.refs.values())
+            stats["bytes_saved"] = total_bytes - self.counters["downloaded_bytes"]
+        return stats
+
+    def log_counters(self):
+        stats = self.get_stats()
+        LOGGER.info(
+            "Perseus assets prefetch: {unique} unique assets, {references} references, "
+            "{hits} hits, {misses} misses, {failed} failed, {mb_saved:.1f}MB saved".format(
+                mb_saved=stats["bytes_saved"] / 1024 / 1024, **stats
+            )
+        )
@@ -0,0 +1,148 @@
+"""
+Local cache of the VTT subtitle files of KA videos that is shared by all chef runs.
+
+The same subtitle files are used by many language channels and variants (dubbed
+videos with subtitles, and the English channel). Each unique (youtube_id, lang)
+subtitle file is downloaded once by a pool of threads, validated, and saved in
+a content-addressed directory, so `SubtitleFile` can be created from local paths.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from pycaption import WebVTTReader
+from ricecooker import config
+from ricecooker.config import LOGGER
+
+from network import make_request
+from network import RequestFailedError
+from network import SUBTITLE_INDEX_MAX_AGE_DAYS
+
+
+SUBTITLE_CACHE_DIR = os.path.join("chefdata", "subtitlecache")
+
+# Index of the cached files {(youtube_id, lang) --> (url, filename, fetched_at)}
+SUBTITLE_CACHE_DB = os.path.join(SUBTITLE_CACHE_DIR, "index.sqlite3")
+
+# Number of threads used to download the subtitle files
+SUBTITLE_WORKERS = 8
+
+# Cached subtitle files older than this are downloaded again
+SUBTITLE_MAX_AGE_DAYS = SUBTITLE_INDEX_MAX_AGE_DAYS
+
+
+def is_valid_vtt(content):
+    """
+    Returns True if the subtitles text `content` is a non-empty WebVTT file.
+    """
+    content = content.lstrip("\ufeff")
+    return bool(content.strip()) and WebVTTReader().detect(content)
+
+
+class SubtitleCache:
+    """
+    Download subtitle files in the background into `cache_dir`, where files are
+    named by the md5 of their content. Each call to `add` returns a future that
+    resolves to the local path of the file, or None if the download failed or
+    the file is not valid WebVTT.
+    """
+
+    def __init__(
+        self,
+        cache_dir=SUBTITLE_CACHE_DIR,
+        db_path=SUBTITLE_CACHE_DB,
+        max_workers=SUBTITLE_WORKERS,
+        max_age_days=SUBTITLE_MAX_AGE_DAYS,
+    ):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age_days * 24 * 3600
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="subtitles"
+        )
+        self.futures = {}  # {(youtube_id, lang) --> Future}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "downloaded": 0, "failed": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS subtitles (
+                    youtube_id TEXT NOT NULL,
+                    lang TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (youtube_id, lang)
+                ) WITHOUT ROWID"""
+            )
+
+    def add(self, youtube_id, lang, url):
+        """
+        Queue the subtitle file at `url` for the video `youtube_id` in `lang`.
+        Returns: a Future that resolves to the local path of the file (or None).
+        """
+        key = (youtube_id, lang)
+        with self.lock:
+            if key not in self.futures:
+                self.futures[key] = self.executor.submit(self._fetch, key, url)
+            return self.futures[key]
+
+    def _get_cached_path(self, key, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename FROM subtitles WHERE youtube_id = ? AND lang = ? "
+                "AND url = ? AND fetched_at >= ?",
+                key + (url, time.time() - self.max_age),
+            ).fetchone()
+        if row:
+            path = os.path.join(self.cache_dir, row[0])
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _fetch(self, key, url):
+        path = self._get_cached_path(key, url)
+        if path:
+            counter = "hits"
+        else:
+            try:
+                # With the Amara API key of the chef's DOMAIN_AUTH_HEADERS, which
+                # uploadchannel sets as the auth of the ricecooker download session
+                response = make_request(url, auth=config.DOWNLOAD_SESSION.auth)
+                content = response.text if response.status_code == 200 else ""
+            except RequestFailedError:
+                content = ""
+            if is_valid_vtt(content):
+                data = content.encode("utf-8")
+                filename = hashlib.md5(data).hexdigest() + ".vtt"
+                path = os.path.join(self.cache_dir, filename)
+                if not os.path.exists(path):
+                    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO subtitles "
+                        "(youtube_id, lang, url, filename, fetched_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        key + (url, filename, time.time()),
+                    )
+                counter = "downloaded"
+            else:
+                LOGGER.warning("Invalid or missing subtitles file " + url)
+                path = None
+                counter = "failed"
+        with self.lock:
+            self.counters[counter] += 1
+        return path
+
+    def log_counters(self):
+        LOGGER.info(
+            "Subtitle files cache: {hits} hits, {downloaded} downloaded, "
+            "{failed} failed".format(**self.counters)
+        )
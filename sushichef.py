@@ -9,6 +9,10 @@ from ricecooker.chefs import SushiChef
 from ricecooker.classes.nodes import ChannelNode
 from ricecooker.config import LOGGER
 
+from assessment_items import ASSESSMENT_ITEMS_MAX_AGE_DAYS
+from assessment_items import PREFETCH_WORKERS
+from transcode_cache import TRANSCODE_CACHE_MAX_GB
+from transcode_pool import get_transcode_workers
 from common_core_tags import generate_common_core_mapping
 from constants import get_channel_title
 from constants import get_channel_description
@@ -141,6 +145,7 @@ class KhanAcademySushiChef(SushiChef):
     slug_blacklist = []  # spec about `KhanTopic`s to be skipped
     topics_by_slug = {}  # lookup table { slug --> KhanTopic }
     topic_replacements = {}  # spec about `KhanTopic`s to be replaced
+    hires_channel = None  # hires tree built by the standard run with hires=both
     DOMAIN_AUTH_HEADERS = {
         "amara.org": {
             "X-api-key": "AMARA_API_KEY",
@@ -161,6 +166,20 @@ class KhanAcademySushiChef(SushiChef):
         hires = bool(kwargs.get("hires", False))
         return lang, variant, hires
 
+    def run(self, args, options):
+        """
+        With the option hires=both, upload the standard and the hires channels,
+        using the hires tree built together with the standard tree.
+        """
+        if options.get("hires") != "both":
+            return super(KhanAcademySushiChef, self).run(args, options)
+        standard_options = dict(options)
+        del standard_options["hires"]
+        standard_options["buildhires"] = True
+        super(KhanAcademySushiChef, self).run(args, standard_options)
+        hires_options = dict(options, hires="1")
+        super(KhanAcademySushiChef, self).run(args, hires_options)
+
     def get_channel_dict(self, kwargs):
         """
         Returns the channel info as a Python dictionary (to avoid duplication).
@@ -194,11 +213,13 @@ class KhanAcademySushiChef(SushiChef):
         """
         Return path to file that contains the ricecooker json tree.
         """
-        lang, variant, _ = self.parse_lang_and_variant_from_kwargs(kwargs)
+        lang, variant, hires = self.parse_lang_and_variant_from_kwargs(kwargs)
         if variant:
             filename_suffix = "{}_{}".format(lang, variant)
         else:
             filename_suffix = lang
+        if hires:
+            filename_suffix += "_hires"
         RICECOOKER_JSON_TREE_TPL = "ricecooker_json_tree_{}.json"
         json_filename = RICECOOKER_JSON_TREE_TPL.format(filename_suffix)
         json_tree_path = os.path.join(self.TREES_DATA_DIR, json_filename)
@@ -212,15 +233,68 @@ class KhanAcademySushiChef(SushiChef):
         - Write ricecooker json tree to the appropriate file
         """
         lang, variant, hires = self.parse_lang_and_variant_from_kwargs(options)
+        if hires and self.hires_channel is not None:
+            # The tree was built by the standard run (hires=both)
+            channel, self.hires_channel = self.hires_channel, None
+            return channel
+        # number of concurrent batched requests used to fetch assessment items
+        item_workers = int(options.get("itemworkers", PREFETCH_WORKERS))
+        # assessment items stored locally are fetched again after this many days
+        items_max_age = int(options.get("itemsmaxage", ASSESSMENT_ITEMS_MAX_AGE_DAYS))
+        # reuse the Studio nodes of exercises whose items have not changed
+        reuse_exercises = bool(options.get("reuseexercises", False))
+        # keep the data of exercise questions on disk instead of in memory
+        spill_questions = bool(options.get("spillquestions", False))
+        # reuse videos that are already on Studio in other KA channels
+        reuse_videos = bool(options.get("reusevideos", False))
+        # download the smallest video source that is large enough for the channel
+        probe_videos = bool(options.get("probevideos", False))
+        # reuse the videos transcoded by previous runs and other channels
+        transcode_cache = bool(options.get("transcodecache", False))
+        transcode_cache_gb = float(
+            options.get("transcodecachegb", TRANSCODE_CACHE_MAX_GB)
+        )
+        # number of parallel video transcodes ("auto" to size from cores and memory)
+        transcode_workers = options.get("transcodeworkers", None)
+        if transcode_workers == "auto":
+            transcode_workers = get_transcode_workers()
+        elif transcode_workers is not None:
+            transcode_workers = int(transcode_workers)
 
         if lang == "en" and variant == "us-cc":
             generate_common_core_mapping()
 
         channel = self.get_channel(**options)
+        # check the video URLs and drop the unavailable ones before building
+        check_videos = bool(options.get("checkvideos", False))
+        # use the shared cache of resized thumbnails
+        cache_thumbnails = bool(options.get("cachethumbnails", False))
+        # also build the hires channel from the same tree (hires=both)
+        hires_channel = None
+        if options.get("buildhires"):
+            hires_channel = self.get_channel(**dict(options, hires="1"))
 
         LOGGER.info("Downloading KA topic tree")
         # Obtain the complete topic tree for lang=lang from the KA API
-        TSVManager(channel, lang=lang, variant=variant, hires=hires)
+        TSVManager(
+            channel,
+            lang=lang,
+            variant=variant,
+            hires=hires,
+            item_workers=item_workers,
+            items_max_age=items_max_age,
+            reuse_exercises=reuse_exercises,
+            spill_questions=spill_questions,
+            reuse_videos=reuse_videos,
+            probe_videos=probe_videos,
+            transcode_cache=transcode_cache,
+            transcode_cache_gb=transcode_cache_gb,
+            transcode_workers=transcode_workers,
+            hires_channel=hires_channel,
+            check_videos=check_videos,
+            cache_thumbnails=cache_thumbnails,
+        )
+        self.hires_channel = hires_channel
 
         return channel
 
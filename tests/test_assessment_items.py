@@ -0,0 +1,90 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricecooker import config  # noqa: E402
+
+import assessment_items  # noqa: E402
+from assessment_items import AssessmentItemsPrefetcher  # noqa: E402
+from assessment_items import AssessmentItemStore  # noqa: E402
+from assessment_items import fetch_assessment_items  # noqa: E402
+from assessment_items import fetch_exercise_assessment_items  # noqa: E402
+from assessment_items import MISSING_ITEM_ERROR  # noqa: E402
+from network import RequestFailedError  # noqa: E402
+
+
+URL = "http://localhost/graphql"
+
+
+def mock_post_request(failing_item_id):
+    """
+    Mock of `post_request` where items whose id starts with "missing" are not
+    found, and the requests for a subset of the items that includes
+    `failing_item_id` fail (as if the server replied 502 to all retries).
+    """
+    requests = []
+
+    def post_request(url, data):
+        item_pairs = [
+            tuple(descriptor.split("|"))
+            for descriptor in data["variables"]["itemDescriptors"]
+        ]
+        requests.append(item_pairs)
+        item_ids = [item_id for _, item_id in item_pairs]
+        if len(requests) > 1 and failing_item_id in item_ids:
+            raise RequestFailedError("Failed to POST {}: 502".format(url))
+        if any(item_id.startswith("missing") for item_id in item_ids):
+            return {
+                "data": {"assessmentItems": None},
+                "errors": [{"message": MISSING_ITEM_ERROR}],
+            }
+        items = [{"id": item_id, "itemData": "{}"} for item_id in item_ids]
+        return {"data": {"assessmentItems": items}}
+
+    return post_request
+
+
+def test_failed_half_fails_the_exercise(monkeypatch):
+    monkeypatch.setattr(assessment_items, "post_request", mock_post_request("a3"))
+    items = fetch_exercise_assessment_items(
+        URL, "e1", ["a1", "a2", "a3", "missing4"]
+    )
+    assert items is None
+
+
+def test_failed_half_is_not_stored(monkeypatch, tmp_path):
+    monkeypatch.setattr(assessment_items, "post_request", mock_post_request("a3"))
+    store = AssessmentItemStore("en", db_path=str(tmp_path / "items.sqlite3"))
+    items_by_exercise = {"e1": ["a1", "a2", "a3", "missing4"], "e2": ["b1", "b2"]}
+    results = fetch_assessment_items(URL, items_by_exercise, store=store)
+    assert "e1" not in results
+    assert [item["id"] for item in results["e2"]] == ["b1", "b2"]
+    # Only the item confirmed missing is stored for the failed exercise
+    assert store.get_items("e1", items_by_exercise["e1"]) == {"missing4": None}
+
+
+def test_prefetch_resolves_futures_when_on_fetched_fails(monkeypatch):
+    monkeypatch.setattr(assessment_items, "post_request", mock_post_request(None))
+
+    def on_fetched(items):
+        raise ValueError("malformed itemData")
+
+    prefetcher = AssessmentItemsPrefetcher(URL, on_fetched=on_fetched, max_items=10)
+    future = prefetcher.add("e1", ["a1", "a2"])
+    prefetcher.flush()
+    items = future.result(timeout=10)
+    assert [item["id"] for item in items] == ["a1", "a2"]
+    assert prefetcher.futures == {}
+
+
+def test_store_is_not_read_with_update(monkeypatch, tmp_path):
+    monkeypatch.setattr(assessment_items, "post_request", mock_post_request(None))
+    store = AssessmentItemStore("en", db_path=str(tmp_path / "items.sqlite3"))
+    store.save_items("e1", [{"id": "a1", "itemData": "old"}])
+    results = fetch_assessment_items(URL, {"e1": ["a1"]}, store=store)
+    assert results["e1"] == [{"id": "a1", "itemData": "old"}]
+    monkeypatch.setattr(config, "UPDATE", True)
+    results = fetch_assessment_items(URL, {"e1": ["a1"]}, store=store)
+    assert results["e1"] == [{"id": "a1", "itemData": "{}"}]
+    assert store.get_item_data("e1", "a1") == "{}"
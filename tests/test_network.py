@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import network  # noqa: E402
+from network import get_sublangscache_index_age  # noqa: E402
+
+
+def amara_video(youtube_id, langs):
+    return {
+        "all_urls": ["http://www.youtube.com/watch?v=" + youtube_id],
+        "languages": [
+            {"code": lang, "published": True, "subtitles_uri": lang + "?format=json"}
+            for lang in langs
+        ],
+    }
+
+
+def get_index_rows(db_path):
+    conn = network._create_sublangscache_index(db_path)
+    rows = conn.execute("SELECT youtube_id, lang FROM subtitles").fetchall()
+    conn.close()
+    return sorted(rows)
+
+
+def test_failed_page_aborts_the_crawl(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "index.sqlite3")
+    monkeypatch.setattr(network, "AMARA_PAGE_SIZE", 1)
+    monkeypatch.setattr(
+        network, "SUBTITLE_LANGUAGES_CACHE_JSON_INDEX", str(tmp_path / "index.json")
+    )
+    pages = {
+        0: {"meta": {"total_count": 3}, "objects": [amara_video("a", ["es"])]},
+        1: None,  # the request failed
+        2: {"meta": {"total_count": 3}, "objects": [amara_video("c", ["fr"])]},
+    }
+
+    def fetch_json(url):
+        return pages[int(url.split("offset=")[1].split("&")[0])]
+
+    monkeypatch.setattr(network, "_fetch_json", fetch_json)
+    with pytest.raises(ConnectionError):
+        network._populate_sublangscache_index(db_path)
+    assert not os.path.exists(db_path)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_failed_video_keeps_the_crawl_time(monkeypatch, tmp_path):
+    db_path = str(tmp_path / "index.sqlite3")
+    conn = network._create_sublangscache_index(db_path)
+    network._save_subtitle_rows(conn, [("a", "es", "a-es"), ("b", "es", "b-es")])
+    crawled_at = time.time() - 3600
+    network._set_crawled_at(conn, crawled_at)
+    conn.close()
+    activity = {"meta": {"next": None}, "objects": [{"video": "A"}, {"video": "B"}]}
+    monkeypatch.setattr(network, "_fetch_json", lambda url: activity)
+    videos = {"A": amara_video("a", ["es", "fr"]), "B": None}  # B failed
+
+    def fetch_amara_video(url):
+        return videos[url.split("/videos/")[1].split("/")[0]]
+
+    monkeypatch.setattr(network, "_fetch_amara_video", fetch_amara_video)
+    network._refresh_sublangscache_index(db_path)
+    assert get_index_rows(db_path) == [("a", "es"), ("a", "fr"), ("b", "es")]
+    assert get_sublangscache_index_age(db_path) >= 3600
+
+    videos["B"] = amara_video("b", [])  # all the subtitles of b were removed
+    network._refresh_sublangscache_index(db_path)
+    assert get_index_rows(db_path) == [("a", "es"), ("a", "fr")]
+    assert get_sublangscache_index_age(db_path) < 60
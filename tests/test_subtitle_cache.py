@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricecooker import config  # noqa: E402
+from ricecooker.utils.request_utils import DomainSpecificAuth  # noqa: E402
+
+from subtitle_cache import SubtitleCache  # noqa: E402
+
+
+VTT = "WEBVTT\n\n00:00:00.000 --> 00:00:01.000\nHello\n"
+
+
+class MockAmaraHandler(BaseHTTPRequestHandler):
+    """
+    Mock of the Amara subtitles endpoint that rejects requests without the key.
+    """
+
+    api_keys = []
+
+    def do_GET(self):
+        self.api_keys.append(self.headers.get("X-api-key"))
+        if self.headers.get("X-api-key") != "secret":
+            self.send_response(403)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(VTT.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+def test_subtitles_are_fetched_with_the_chef_auth(monkeypatch, tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockAmaraHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = "127.0.0.1:{}".format(server.server_port)
+    monkeypatch.setenv("AMARA_API_KEY", "secret")
+    auth = DomainSpecificAuth({host: {"X-api-key": "AMARA_API_KEY"}})
+    monkeypatch.setattr(config.DOWNLOAD_SESSION, "auth", auth)
+    try:
+        cache = SubtitleCache(
+            cache_dir=str(tmp_path), db_path=str(tmp_path / "index.sqlite3")
+        )
+        url = "http://{}/api/videos/abc/languages/es/subtitles/?format=vtt".format(host)
+        path = cache.add("abc", "es", url).result()
+    finally:
+        server.shutdown()
+    assert MockAmaraHandler.api_keys == ["secret"]
+    with open(path) as f:
+        assert f.read() == VTT
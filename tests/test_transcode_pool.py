@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ricecooker.classes.files import VideoFile  # noqa: E402
+
+from transcode_pool import PooledVideoFile  # noqa: E402
+from transcode_pool import TranscodePool  # noqa: E402
+
+
+class MockVideoFile:
+    def __init__(self, path, processed, fail=False):
+        self.path = path
+        self.processed = processed
+        self.fail = fail
+
+    def process_file(self):
+        self.processed.append(self.path)
+        if self.fail:
+            raise IOError("ffmpeg failed")
+        return self.path + ".out"
+
+
+class MockVideo:
+    def __init__(self, video_file):
+        self.video_file = video_file
+        self.transcode_future = None
+
+
+def test_longest_videos_first_and_failed_jobs():
+    processed = []
+    durations = {"short": 10, "long": 600, "medium": 120, "unknown": None}
+    videos = dict(
+        (path, MockVideo(MockVideoFile(path, processed, fail=path == "medium")))
+        for path in durations
+    )
+    pool = TranscodePool(max_workers=1)
+    # Block the single worker until all the videos are submitted
+    started = threading.Event()
+    pool.executor.submit(started.wait)
+    for path, duration in durations.items():
+        pool.add(videos[path], duration)
+    pool.start()
+    started.set()
+    results = dict(
+        (path, video.transcode_future.result()) for path, video in videos.items()
+    )
+    assert processed == ["long", "medium", "short", "unknown"]
+    assert results["long"] == "long.out"
+    assert results["medium"] is None
+    stats = pool.get_stats()
+    assert stats["done"] == 3 and stats["failed"] == 1
+
+
+def test_pooled_video_file_is_not_processed_again(monkeypatch):
+    video_file = PooledVideoFile("http://v/1.mp4", ffmpeg_settings={"max_height": 480})
+    video_file.filename = "abc.mp4"  # processed by the pool
+    monkeypatch.setattr(VideoFile, "process_file", lambda self: "again.mp4")
+    assert video_file.process_file() == "abc.mp4"
+    video_file.filename = None  # the pool job failed
+    assert video_file.process_file() == "again.mp4"
@@ -0,0 +1,157 @@
+import json
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from le_utils.constants import exercises  # noqa: E402
+from ricecooker.classes.licenses import CC_BYLicense  # noqa: E402
+from ricecooker.classes.nodes import ChannelNode  # noqa: E402
+from ricecooker.classes.nodes import TopicNode  # noqa: E402
+
+from assessment_items import AssessmentItemStore  # noqa: E402
+import tsvkhan  # noqa: E402
+from tsvkhan import KhanExercise  # noqa: E402
+from tsvkhan import KhanVideo  # noqa: E402
+from tsvkhan import TSVManager  # noqa: E402
+
+
+class MockRemoteNodes:
+    """
+    RemoteNodesIndex with the assessment metadata of one exercise node.
+    """
+
+    def __init__(self, item_ids, mastery_model):
+        self.metadata = {
+            "assessment_item_ids": [
+                uuid.uuid5(uuid.NAMESPACE_DNS, item_id).hex for item_id in item_ids
+            ],
+            "mastery_model": json.dumps(mastery_model),
+        }
+
+    def get_assessment_metadata(self, node_id):
+        return self.metadata
+
+
+def make_exercise_in(parent, lang="es"):
+    exercise = KhanExercise(
+        "x1", "Title", "", "slug-x1", None, ["a1", "a2", "a3"], "do-all", "", lang
+    )
+    parent.add_child(exercise)
+    return exercise
+
+
+def make_exercise(lang):
+    channel = ChannelNode("channel", "khanacademy.org", "Channel", language=lang)
+    return make_exercise_in(channel, lang)
+
+
+def test_fuv_exercise_is_reused_with_stored_items(tmp_path):
+    store = AssessmentItemStore("fuv", db_path=str(tmp_path / "items.sqlite3"))
+    store.save_items(
+        "x1", [{"id": "a1", "itemData": "{}"}, {"id": "a2", "itemData": "{}"}]
+    )
+    store.save_missing_items("x1", ["a3"])
+    remote_nodes = MockRemoteNodes(
+        ["a1", "a2"], {"type": exercises.M_OF_N, "m": 2, "n": 2}
+    )
+
+    exercise = make_exercise("fuv")
+    exercise._set_remote_node(remote_nodes, "c" * 32)
+    assert not exercise.remote_node  # the items are needed
+
+    exercise = make_exercise("fuv")
+    exercise._set_remote_node(remote_nodes, "c" * 32, store)
+    assert exercise.remote_node
+
+
+def test_exercise_is_not_reused_when_items_changed(tmp_path):
+    store = AssessmentItemStore("es", db_path=str(tmp_path / "items.sqlite3"))
+    store.save_items(
+        "x1", [{"id": item_id, "itemData": "{}"} for item_id in ["a1", "a2", "a3"]]
+    )
+    remote_nodes = MockRemoteNodes(["a1", "a2"], {"type": exercises.DO_ALL})
+    exercise = make_exercise("es")
+    exercise._set_remote_node(remote_nodes, "c" * 32, store)
+    assert not exercise.remote_node
+
+
+class MockPrefetcher:
+    def __init__(self):
+        self.added = []
+
+    def add(self, exercise_id, item_ids):
+        self.added.append(exercise_id)
+        return "future:" + exercise_id
+
+
+class MockNoRemoteNodes:
+    def has_video_file(self, node_id):
+        return False
+
+
+def make_manager():
+    """
+    A TSVManager with only the attributes used by `_clone_tree`.
+    """
+    manager = TSVManager.__new__(TSVManager)
+    manager.reuse_exercises = False
+    manager.item_store = None
+    manager.asset_prefetcher = None
+    manager.question_store = None
+    manager.prefetcher = MockPrefetcher()
+    manager.subtitle_cache = None
+    manager.video_index = None
+    manager.source_index = None
+    manager.transcode_cache = None
+    manager.transcode_pool = None
+    return manager
+
+
+def test_clone_tree_for_hires_channel(monkeypatch):
+    monkeypatch.setattr(
+        tsvkhan, "get_nodes_for_remote_files", lambda _: MockNoRemoteNodes()
+    )
+    channel = ChannelNode("channel", "khanacademy.org", "Channel", language="es")
+    hires_channel = ChannelNode(
+        "channel-hires", "khanacademy.org", "Channel HD", language="es"
+    )
+    topic = TopicNode("topic", "Topic")
+    channel.add_child(topic)
+    video = KhanVideo(
+        "slug-v1",
+        "Video",
+        "",
+        None,
+        CC_BYLicense("Khan Academy"),
+        [{"filetype": "mp4", "url": "http://v/1.mp4"}],
+        "youtube1",
+        "youtube1",
+        subbed=False,
+        dubbed=False,
+        dub_subbed=False,
+        lang="es",
+        target_lang="es",
+        hires=False,
+        channel_id=channel.get_node_id().hex,
+    )
+    topic.add_child(video)
+    video._set_video_files(MockNoRemoteNodes())
+    exercise = make_exercise_in(topic)
+
+    make_manager()._clone_tree(channel, hires_channel)
+
+    [hires_topic] = hires_channel.children
+    hires_video, hires_exercise = hires_topic.children
+    assert hires_topic.title == "Topic"
+    pairs = [(topic, hires_topic), (video, hires_video), (exercise, hires_exercise)]
+    for node, clone in pairs:
+        assert clone.get_content_id() == node.get_content_id()
+        assert clone.get_node_id() != node.get_node_id()
+    assert video.video_file.context["video_settings"] == {"max_height": 480}
+    assert hires_video.video_file.context["video_settings"] == {"max_height": 720}
+    assert hires_video.video_file is not video.video_file
+    assert hires_video.files == [hires_video.video_file]
+    assert hires_exercise.prefetched_items == "future:x1"
+    assert hires_exercise.questions == []
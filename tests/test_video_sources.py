@@ -0,0 +1,77 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import video_sources  # noqa: E402
+from video_sources import VideoURLChecker  # noqa: E402
+
+
+MB = 1024 * 1024
+
+# HEAD results {url --> (status, size)}; None is a connection error
+HEAD_RESULTS = {
+    "http://v/1.mp4": (200, 30 * MB),
+    "http://v/1-low.mp4": (200, 10 * MB),
+    "http://v/1-ios.mp4": (404, None),
+    "http://v/2.mp4": (410, None),
+    "http://v/2-low.mp4": (404, None),
+    "http://v/3.mp4": (None, None),
+    "http://v/3-low.mp4": (503, None),
+    "http://v/4.mp4": (200, 50 * MB),
+}
+
+
+def make_video(*urls):
+    filetypes = ["mp4", "mp4-low", "mp4-low-ios"]
+    return {
+        "kind": "Video",
+        "download_urls": [
+            {"filetype": filetype, "url": url} for filetype, url in zip(filetypes, urls)
+        ],
+    }
+
+
+def make_tree():
+    return {
+        "v1": make_video("http://v/1.mp4", "http://v/1-low.mp4", "http://v/1-ios.mp4"),
+        "v2": make_video("http://v/2.mp4", "http://v/2-low.mp4"),
+        "v3": make_video("http://v/3.mp4", "http://v/3-low.mp4"),
+        "v4": make_video("http://v/4.mp4"),
+        "e1": {"kind": "Exercise"},
+    }
+
+
+def test_check_tree(monkeypatch, tmp_path):
+    checked = []
+
+    def head_request(url):
+        checked.append(url)
+        return HEAD_RESULTS[url]
+
+    monkeypatch.setattr(video_sources, "head_request", head_request)
+    tree = make_tree()
+    checker = VideoURLChecker(db_path=str(tmp_path / "sources.sqlite3"))
+    stats = checker.check_tree(tree)
+
+    def get_urls(node_id):
+        return [durl["url"] for durl in tree[node_id]["download_urls"]]
+
+    # Only the 404 and 410 URLs are removed
+    assert get_urls("v1") == ["http://v/1.mp4", "http://v/1-low.mp4"]
+    assert get_urls("v2") == []
+    assert get_urls("v3") == ["http://v/3.mp4", "http://v/3-low.mp4"]
+    assert get_urls("v4") == ["http://v/4.mp4"]
+    assert stats["urls"] == 8
+    assert stats["dead_urls"] == 3
+    assert stats["dead_videos"] == 1
+    # v1 downloads mp4 by default, and mp4-low is the smallest; v3 is unknown
+    assert stats["default_bytes"] == 80 * MB
+    assert stats["smallest_bytes"] == 60 * MB
+
+    # Only the available URLs are not checked again
+    checked.clear()
+    checker.check_tree(make_tree())
+    assert sorted(checked) == sorted(
+        url for url, (status, _) in HEAD_RESULTS.items() if status != 200
+    )
@@ -0,0 +1,177 @@
+"""
+Local cache of the thumbnails of KA videos and exercises that is shared by all
+chef runs.
+
+The same thumbnails are used in all the variants and language channels. Each
+unique thumbnail URL in the TSV data is downloaded once by a pool of threads,
+resized to the ricecooker thumbnail size, and saved in a content-addressed
+directory, so that the `ThumbnailFile`s of the nodes can use local paths.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+from ricecooker.config import LOGGER
+from ricecooker.utils.images import scale_and_crop_thumbnail
+from ricecooker.utils.images import THUMBNAIL_SIZE
+
+from network import make_request
+
+
+THUMBNAIL_CACHE_DIR = os.path.join("chefdata", "thumbnailcache")
+
+# Index of the cached files {(url, size) --> (filename, fetched_at)}
+THUMBNAIL_CACHE_DB = os.path.join(THUMBNAIL_CACHE_DIR, "index.sqlite3")
+
+# Number of threads used to download and resize the thumbnails
+THUMBNAIL_WORKERS = 8
+
+# Cached thumbnails older than this are downloaded again
+THUMBNAIL_MAX_AGE_DAYS = 30
+
+# Content kinds of the TSV data whose `thumbnail_url` is used
+THUMBNAIL_KINDS = ["Video", "Exercise"]
+
+
+def resize_thumbnail(content, size=THUMBNAIL_SIZE):
+    """
+    Scale and crop the image `content` (bytes) to `size`.
+    Returns: tuple (data, extension) of the resized image, in JPEG format for
+    JPEG images and PNG otherwise.
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        if image.format == "JPEG":
+            image_format, extension = "JPEG", "jpg"
+            image = image.convert("RGB")
+        else:
+            image_format, extension = "PNG", "png"
+            image = image.convert("RGBA")
+        image = scale_and_crop_thumbnail(image, size=size)
+        output = io.BytesIO()
+        image.save(output, image_format)
+    return output.getvalue(), extension
+
+
+class ThumbnailCache:
+    """
+    Download and resize thumbnails in the background into `cache_dir`, where files
+    are named by the md5 of their content. Each call to `add` returns a future
+    that resolves to the local path of the thumbnail, or None if the download or
+    the resize failed.
+    """
+
+    def __init__(
+        self,
+        cache_dir=THUMBNAIL_CACHE_DIR,
+        db_path=THUMBNAIL_CACHE_DB,
+        max_workers=THUMBNAIL_WORKERS,
+        max_age_days=THUMBNAIL_MAX_AGE_DAYS,
+        size=THUMBNAIL_SIZE,
+    ):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age_days * 24 * 3600
+        self.size = size
+        self.size_key = "{}x{}".format(*size)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="thumbnails"
+        )
+        self.futures = {}  # {url --> Future}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "downloaded": 0, "failed": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS thumbnails (
+                    url TEXT NOT NULL,
+                    size TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (url, size)
+                ) WITHOUT ROWID"""
+            )
+
+    def add(self, url):
+        """
+        Queue the thumbnail at `url`.
+        Returns: a Future that resolves to the local path of the file (or None).
+        """
+        with self.lock:
+            if url not in self.futures:
+                self.futures[url] = self.executor.submit(self._fetch, url)
+            return self.futures[url]
+
+    def add_tree(self, tree_dict):
+        """
+        Queue the thumbnails of all the videos and exercises in `tree_dict`.
+        """
+        for node in tree_dict.values():
+            if node["kind"] in THUMBNAIL_KINDS and node.get("thumbnail_url"):
+                self.add(node["thumbnail_url"])
+
+    def get_path(self, url):
+        """
+        Returns the local path of the thumbnail at `url`, or `url` if it could
+        not be cached.
+        """
+        return self.add(url).result() or url
+
+    def _get_cached_path(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename FROM thumbnails WHERE url = ? AND size = ? "
+                "AND fetched_at >= ?",
+                (url, self.size_key, time.time() - self.max_age),
+            ).fetchone()
+        if row:
+            path = os.path.join(self.cache_dir, row[0])
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _fetch(self, url):
+        path = self._get_cached_path(url)
+        if path:
+            counter = "hits"
+        else:
+            try:
+                response = make_request(url)
+                if response.status_code != 200:
+                    raise IOError("HTTP status {}".format(response.status_code))
+                data, extension = resize_thumbnail(response.content, self.size)
+            except (IOError, ValueError) as e:  # including RequestFailedError
+                LOGGER.warning("Invalid or missing thumbnail {}: {}".format(url, e))
+                data = None
+            if data:
+                filename = hashlib.md5(data).hexdigest() + "." + extension
+                path = os.path.join(self.cache_dir, filename)
+                if not os.path.exists(path):
+                    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO thumbnails "
+                        "(url, size, filename, fetched_at) VALUES (?, ?, ?, ?)",
+                        (url, self.size_key, filename, time.time()),
+                    )
+                counter = "downloaded"
+            else:
+                path = None
+                counter = "failed"
+        with self.lock:
+            self.counters[counter] += 1
+        return path
+
+    def log_counters(self):
+        LOGGER.info(
+            "Thumbnails cache: {hits} hits, {downloaded} downloaded, "
+            "{failed} failed".format(**self.counters)
+        )
@@ -0,0 +1,232 @@
+"""
+Local cache of the transcoded video files that is shared by all channels and runs.
+
+The same KA video (e.g. an untranslated English video) is included in many
+language and variant channels, and each channel downloads and transcodes it with
+the same `ffmpeg_settings`. The transcoded outputs are saved once in a cache
+directory, indexed by (source URL, ffmpeg settings), and hardlinked (or copied)
+into the ricecooker storage of each run. The least recently used outputs are
+evicted when the cache is larger than its disk budget.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from ricecooker import config
+from ricecooker.classes.files import VideoFile
+from ricecooker.config import LOGGER
+
+
+# The cache can be shared by chef checkouts by setting this environment variable
+TRANSCODE_CACHE_DIR = os.environ.get(
+    "TRANSCODE_CACHE_DIR", os.path.join("chefdata", "transcodecache")
+)
+
+# Disk budget of the cache, in GB (the LRU files are removed beyond this size)
+TRANSCODE_CACHE_MAX_GB = 100
+
+# Attributes set by the ricecooker file pipeline that are saved with each output
+CACHED_FILE_ATTRIBUTES = ["original_filename", "duration", "preset", "language"]
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink `src` to `dst`, or copy it if they are on different filesystems.
+    Existing `dst` files are kept, since all the paths are content-addressed.
+    """
+    if os.path.exists(dst):
+        return
+    tmp_path = "{}.{}.tmp".format(dst, threading.get_ident())
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class TranscodeCache:
+    """
+    Index of the transcoded outputs in `cache_dir` {(source, settings) --> file}.
+    Outputs are looked up with `get`, which links the file into the ricecooker
+    storage directory, and saved with `put` after a transcode.
+    """
+
+    def __init__(self, cache_dir=TRANSCODE_CACHE_DIR, max_gb=TRANSCODE_CACHE_MAX_GB):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = int(max_gb * 1024 * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "bytes_saved": 0, "evicted": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        db_path = os.path.join(self.cache_dir, "index.sqlite3")
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS outputs (
+                    source TEXT NOT NULL,
+                    settings TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    attributes TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (source, settings)
+                ) WITHOUT ROWID"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)"
+            )
+
+    @staticmethod
+    def get_settings_key(ffmpeg_settings):
+        """
+        Returns the canonical string of the `ffmpeg_settings` dict used as key.
+        """
+        return json.dumps(ffmpeg_settings or {}, sort_keys=True)
+
+    def get(self, source, settings):
+        """
+        Look up the output of transcoding `source` with `settings` (a key returned
+        by `get_settings_key`), and link it into the ricecooker storage.
+        Returns: tuple (filename, attributes dict), or None if not cached.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT filename, size, attributes FROM outputs "
+                "WHERE source = ? AND settings = ?",
+                (source, settings),
+            ).fetchone()
+        path = row and os.path.join(self.cache_dir, row[0])
+        if not row or not os.path.exists(path):
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+        filename, size, attributes = row
+        link_or_copy(path, config.get_storage_path(filename))
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE outputs SET last_used = ? WHERE source = ? AND settings = ?",
+                (time.time(), source, settings),
+            )
+            self.counters["hits"] += 1
+            self.counters["bytes_saved"] += size
+        return filename, json.loads(attributes)
+
+    def put(self, source, settings, filename, attributes):
+        """
+        Save the output `filename` (in the ricecooker storage) of transcoding
+        `source` with `settings`, and evict old outputs if over the budget.
+        """
+        storage_path = config.get_storage_path(filename)
+        link_or_copy(storage_path, os.path.join(self.cache_dir, filename))
+        size = os.path.getsize(storage_path)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO outputs "
+                "(source, settings, filename, size, attributes, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (source, settings, filename, size, json.dumps(attributes), time.time()),
+            )
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used outputs until the cache fits its budget.
+        """
+        with self.lock, self.conn:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM outputs"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self.conn.execute(
+                "SELECT source, settings, filename, size FROM outputs "
+                "ORDER BY last_used"
+            ).fetchall()
+            evicted = []
+            for source, settings, filename, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((source, settings, filename))
+                total -= size
+            for source, settings, filename in evicted:
+                self.conn.execute(
+                    "DELETE FROM outputs WHERE source = ? AND settings = ?",
+                    (source, settings),
+                )
+                # The same output may be shared by several (source, settings) keys
+                in_use = self.conn.execute(
+                    "SELECT 1 FROM outputs WHERE filename = ? LIMIT 1", (filename,)
+                ).fetchone()
+                if not in_use:
+                    try:
+                        os.remove(os.path.join(self.cache_dir, filename))
+                    except FileNotFoundError:
+                        pass
+            self.counters["evicted"] += len(evicted)
+
+    def get_stats(self):
+        """
+        Returns a dict with the cache counters and the `hit_rate` of this run.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def log_counters(self):
+        stats = self.get_stats()
+        LOGGER.info(
+            "Transcoded videos cache: {hits} hits, {misses} misses ({rate:.0f}% hit rate), "
+            "{evicted} evicted, {mb_saved:.1f}MB saved".format(
+                rate=stats["hit_rate"] * 100,
+                mb_saved=stats["bytes_saved"] / 1024 / 1024,
+                **stats
+            )
+        )
+
+
+class CachedVideoFile(VideoFile):
+    """
+    A `VideoFile` that is served from the `transcode_cache` when the same source
+    was already transcoded with the same `ffmpeg_settings`.
+    """
+
+    def __init__(self, path, ffmpeg_settings=None, transcode_cache=None, **kwargs):
+        super(CachedVideoFile, self).__init__(
+            path, ffmpeg_settings=ffmpeg_settings, **kwargs
+        )
+        self.transcode_cache = transcode_cache
+        # Only the videos that are transcoded are cached
+        if ffmpeg_settings or config.COMPRESS:
+            self.settings_key = TranscodeCache.get_settings_key(
+                ffmpeg_settings or {"max_height": config.VIDEO_HEIGHT or 480}
+            )
+        else:
+            self.settings_key = None
+
+    def process_file(self):
+        if self.filename:
+            # Already processed (e.g. by the transcode pool)
+            return self.filename
+        if self.transcode_cache is None or self.settings_key is None:
+            return super(CachedVideoFile, self).process_file()
+        if not config.UPDATE:
+            cached = self.transcode_cache.get(self.path, self.settings_key)
+            if cached:
+                self.filename, attributes = cached
+                for key, value in attributes.items():
+                    setattr(self, key, value)
+                return self.filename
+        filename = super(CachedVideoFile, self).process_file()
+        if filename:
+            attributes = dict(
+                (key, getattr(self, key))
+                for key in CACHED_FILE_ATTRIBUTES
+                if getattr(self, key, None) is not None
+            )
+            self.transcode_cache.put(self.path, self.settings_key, filename, attributes)
+        return filename
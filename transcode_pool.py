@@ -0,0 +1,132 @@
+"""
+Parallel download and transcode of the video files of the channel.
+
+Ricecooker processes the files of each node in the order of the tree, so the
+videos are transcoded in the same threads as all the other nodes. The video
+files are instead queued in a pool of threads (each running one ffmpeg process)
+sized from the number of cores and the available memory, with the longest
+videos first so that the pool stays busy until the end.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+from ricecooker import config
+from ricecooker.classes.files import VideoFile
+from ricecooker.config import LOGGER
+
+
+# Memory used by one ffmpeg transcode of a KA video, in MB
+TRANSCODE_JOB_MEMORY_MB = 768
+
+
+def get_transcode_workers(job_memory_mb=TRANSCODE_JOB_MEMORY_MB):
+    """
+    Returns the number of transcode jobs that can run in parallel, given the
+    number of cores and the memory that is available to new processes.
+    """
+    cores = os.cpu_count() or 1
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return cores
+    return max(1, min(cores, available // (job_memory_mb * 1024 * 1024)))
+
+
+class PooledVideoFile(VideoFile):
+    """
+    A `VideoFile` that is not processed again by ricecooker after it was
+    processed by the transcode pool (with `--update` it would be downloaded and
+    transcoded twice). Failed jobs have no `filename`, so they are processed again.
+    """
+
+    def process_file(self):
+        if self.filename:
+            return self.filename
+        return super(PooledVideoFile, self).process_file()
+
+
+class TranscodePool:
+    """
+    Process the video files added with `add` in a pool of `max_workers` threads,
+    longest videos first, once `start` is called. The future of each video file
+    is saved as `video.transcode_future`. Failed jobs are not retried here: the
+    video file is processed again by ricecooker, which reports the error.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or get_transcode_workers()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="transcode"
+        )
+        self.jobs = []  # (duration, video)
+        self.lock = threading.Lock()
+        self.timings = []  # (seconds, path)
+        self.counters = {"done": 0, "failed": 0}
+        self.started_at = None
+        self.finished_at = None
+
+    def add(self, video, duration=None):
+        """
+        Queue the `video_file` of the KhanVideo `video`, using the `duration` in
+        seconds from the TSV data (if available) to schedule it.
+        """
+        self.jobs.append((duration or 0, video))
+
+    def start(self):
+        """
+        Submit all the queued jobs, in order of decreasing duration.
+        """
+        LOGGER.info(
+            "Transcoding {} video files with {} workers".format(
+                len(self.jobs), self.max_workers
+            )
+        )
+        self.started_at = time.time()
+        self.jobs.sort(key=lambda job: job[0], reverse=True)
+        for _, video in self.jobs:
+            video.transcode_future = self.executor.submit(
+                self._process, video.video_file
+            )
+        self.jobs = []
+
+    def _process(self, video_file):
+        start = time.time()
+        try:
+            filename = video_file.process_file()
+        except Exception as e:
+            LOGGER.error("Transcode of {} failed: {}".format(video_file.path, e))
+            filename = None
+        if not filename and video_file in config.FAILED_FILES:
+            # The failure is reported when ricecooker processes the file again
+            config.FAILED_FILES.remove(video_file)
+        with self.lock:
+            self.timings.append((time.time() - start, video_file.path))
+            self.counters["done" if filename else "failed"] += 1
+            self.finished_at = time.time()
+        return filename
+
+    def get_stats(self):
+        """
+        Returns a dict with the job counters, the total and longest job times,
+        and the wall time from the start of the pool to the last completed job.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats["job_seconds"] = sum(seconds for seconds, _ in self.timings)
+            stats["longest"] = max(self.timings, default=(0, None))
+            if self.finished_at:
+                stats["wall_seconds"] = self.finished_at - self.started_at
+            else:
+                stats["wall_seconds"] = 0
+        return stats
+
+    def log_counters(self):
+        stats = self.get_stats()
+        LOGGER.info(
+            "Transcode pool: {done} done, {failed} failed, {job_seconds:.0f}s of jobs "
+            "in {wall_seconds:.0f}s, longest job {longest[0]:.0f}s ({longest[1]})".format(
+                **stats
+            )
+        )
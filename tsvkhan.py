@@ -4,6 +4,9 @@ Logic for parsing the "flat" lists of TSV data from Khan Academy and
 converting to a topic tree of ricecooker classes.
 """
 import argparse
+import atexit
+from collections import ChainMap
+import copy
 import csv
 from google.cloud import storage
 from html2text import html2text
@@ -12,11 +15,14 @@ import json
 from operator import itemgetter
 import os
 import re
+import sqlite3
+import uuid
 
 from le_utils.constants import content_kinds, exercises, file_formats, format_presets
 
 from ricecooker.config import LOGGER
 from ricecooker.classes.files import SubtitleFile
+from ricecooker.classes.files import ThumbnailFile
 from ricecooker.classes.files import VideoFile
 from ricecooker.classes.licenses import SpecialPermissionsLicense
 from ricecooker.classes.nodes import Node
@@ -25,23 +31,45 @@ from ricecooker.classes.nodes import ExerciseNode
 from ricecooker.classes.nodes import StudioContentNode
 from ricecooker.classes.nodes import TopicNode
 from ricecooker.classes.questions import PerseusQuestion
-from ricecooker.config import LOGGER
 from ricecooker.utils.youtube import get_language_with_alpha2_fallback
 
+from assessment_items import ASSESSMENT_ITEMS_MAX_AGE_DAYS
+from assessment_items import AssessmentItemsPrefetcher
+from assessment_items import AssessmentItemStore
+from assessment_items import fetch_assessment_items
+from assessment_items import get_assessment_items_url
+from assessment_items import get_item_ids_with_data
+from assessment_items import PREFETCH_WORKERS
+from assessment_items import QuestionSpillStore
 from common_core_tags import CC_MAPPING
 from constants import SUPPORTED_LANGS
 from constants import KHAN_ACADEMY_LANGUAGE_MAPPING
 from constants import LICENSE_MAPPING
+from curation import compile_topic_tree_replacements
 from curation import get_slug_blacklist
-from curation import get_topic_tree_replacements
 from curation import METADATA_BY_SLUG
 from curation import TOPIC_TREE_REPLACMENTS_PER_LANG
 from crowdin import retrieve_translations
 from kolibridb import get_nodes_for_remote_files
-from network import post_request
+from kolibridb import VideoReuseIndex
+from metadata_mapping import METADATA_MAPPING_DB
+from metadata_mapping import MetadataMappingStore
+from metadata_mapping import write_metadata_mapping
 from network import get_subtitles
+from perseus_assets import PerseusAssetPrefetcher
+from subtitle_cache import SubtitleCache
+from thumbnail_cache import ThumbnailCache
+from transcode_cache import CachedVideoFile
+from transcode_cache import TranscodeCache
+from transcode_cache import TRANSCODE_CACHE_MAX_GB
+from transcode_pool import PooledVideoFile
+from transcode_pool import TranscodePool
+from video_sources import select_video_source
+from video_sources import VideoSourceIndex
+from video_sources import VideoURLChecker
 
 translations = {}
+metadata_store = None  # MetadataMappingStore used by non-English channels
 
 TOPIC_LIKE_KINDS = ["Domain", "Course", "Unit", "Lesson"]
 SUPPORTED_KINDS = TOPIC_LIKE_KINDS + ["Exercise", "Video"]
@@ -110,7 +138,18 @@ def get_khan_tsv(lang, update=False):
     return data
 
 
-METADATA_MAPPING_FILE = "chefdata/metadata_mapping.json"
+METADATA_MAPPING_FILE = METADATA_MAPPING_DB
+
+
+def get_slug_metadata(slug):
+    """
+    Returns the metadata (grade_levels and categories) to use for node `slug`:
+    from the metadata mapping for non-English channels, or else from the
+    topic metadata in METADATA_BY_SLUG.
+    """
+    if metadata_store is not None:
+        return metadata_store.get(slug)
+    return METADATA_BY_SLUG.get(slug, {})
 
 
 class TSVManager:
@@ -123,6 +162,18 @@ class TSVManager:
         onlylisted=True,
         verbose=False,
         hires=False,
+        item_workers=PREFETCH_WORKERS,
+        items_max_age=ASSESSMENT_ITEMS_MAX_AGE_DAYS,
+        reuse_exercises=False,
+        spill_questions=False,
+        reuse_videos=False,
+        probe_videos=False,
+        transcode_cache=False,
+        transcode_cache_gb=TRANSCODE_CACHE_MAX_GB,
+        transcode_workers=None,
+        hires_channel=None,
+        check_videos=False,
+        cache_thumbnails=False,
     ):
         """
         Build the complete topic tree based on the results obtained from the KA API.
@@ -137,8 +188,15 @@ class TSVManager:
         # Get fresh TSV data (combined topics, videos, exercises, etc.)
         self.tree_dict = get_khan_tsv(lang, update=update)  # a {id --> datum} dict
 
-        # Check if we should generate metadata mapping
-        self.generate_metadata = (lang == "en" and variant is None)
+        # The English channel without variant is only used to generate the
+        # metadata mapping, which doesn't require building the ricecooker tree
+        if lang == "en" and variant is None:
+            generate_metadata_mapping(tree_dict=self.tree_dict)
+            exit(0)
+
+        # Optionally drop the unavailable video URLs before building the tree
+        if check_videos:
+            VideoURLChecker().check_tree(self.tree_dict)
 
         if lang not in SUPPORTED_LANGS:
             global translations
@@ -146,62 +204,183 @@ class TSVManager:
 
         self.channel_id = channel.get_node_id().hex
 
-        self.remote_nodes = get_nodes_for_remote_files(self.channel_id) if not self.generate_metadata else {}
+        self.remote_nodes = get_nodes_for_remote_files(self.channel_id)
+        self.video_index = VideoReuseIndex() if reuse_videos else None
         self.update = update
         self.onlylisted = onlylisted
         self.lang = lang
         self.variant = variant
         self.verbose = verbose
         self.hires = hires
+        self.reuse_exercises = reuse_exercises
         self.node_report = []
 
-        self.collected_nodes = {} if self.generate_metadata else None
-
-        # Load JSON mapping for source_id to metadata (skip if generating)
-        if not self.generate_metadata:
-            try:
-                with open(METADATA_MAPPING_FILE, 'r', encoding='utf-8') as f:
-                    # Clear all existing entries, which are only for topic metadata
-                    METADATA_BY_SLUG.clear()
-                    # Load in resource only metadata
-                    METADATA_BY_SLUG.update(json.load(f))
-                LOGGER.info(f"Loaded metadata mapping from {METADATA_MAPPING_FILE}")
-            except (json.JSONDecodeError, IOError) as e:
-                LOGGER.error(f"Failed to load metadata mapping. Rerun with lang=en and no variant to force generation.")
-                exit(1)
-
-        root_children = []
-        domains = [row for row in self.tree_dict.values() if row["kind"] == "Domain"]
-        domains_by_slug = dict((domain["slug"], domain) for domain in domains)
-        for domain_slug in DOMAINS_SORT_ORDER:
-            if domain_slug in domains_by_slug:
-                domain = domains_by_slug[domain_slug]
-                root_children.append({"kind": "Domain", "id": domain["id"]})
-
-        # Build a lookup table {slug --> KhanTopic} to be used for replacement logic
-        self.topics_by_slug = {}
+        # Assessment items are fetched in the background while building the tree,
+        # except for items that are already in the local store and not stale
+        kalang = KHAN_ACADEMY_LANGUAGE_MAPPING.get(lang, lang)
+        self.item_store = AssessmentItemStore(kalang, max_age_days=items_max_age)
+        # and so are the images of the items (see KhanExercise.process_files)
+        self.asset_prefetcher = PerseusAssetPrefetcher(kalang)
+        # The assets are processed by ricecooker after the tree is built
+        atexit.register(self.asset_prefetcher.log_counters)
+        # Subtitle files are downloaded in the background into a shared cache
+        self.subtitle_cache = SubtitleCache()
+        self.subtitled_videos = []
+        # Optionally download and resize the thumbnails in the background into a
+        # shared cache, so the nodes use local files (see _set_local_thumbnails)
+        self.thumbnail_cache = None
+        if cache_thumbnails:
+            self.thumbnail_cache = ThumbnailCache()
+            self.thumbnail_cache.add_tree(self.tree_dict)
+        # Optionally probe the resolution of the video sources in the background,
+        # to download the smallest source that is large enough for the channel
+        self.source_index = VideoSourceIndex() if probe_videos else None
+        if self.source_index is not None:
+            for node in self.tree_dict.values():
+                if node["kind"] == "Video" and node.get("fully_translated", True):
+                    self.source_index.add_download_urls(node["download_urls"] or [])
+        # Optionally reuse the videos transcoded by previous runs and other channels
+        self.transcode_cache = None
+        if transcode_cache:
+            self.transcode_cache = TranscodeCache(max_gb=transcode_cache_gb)
+            # Video files are processed by ricecooker after the tree is built
+            atexit.register(self.transcode_cache.log_counters)
+        # Optionally transcode the video files in parallel, longest videos first
+        self.transcode_pool = None
+        if transcode_workers is not None:
+            self.transcode_pool = TranscodePool(max_workers=transcode_workers)
+            atexit.register(self.transcode_pool.log_counters)
+
+        # Optionally keep the question data on disk instead of in memory
+        self.question_store = QuestionSpillStore() if spill_questions else None
+        self.prefetcher = AssessmentItemsPrefetcher(
+            get_assessment_items_url(kalang),
+            max_workers=item_workers,
+            store=self.item_store,
+            on_fetched=self.asset_prefetcher.prefetch_items,
+            keep_items=not spill_questions,
+        )
 
-        for node in self.tree_dict.values():
-            if node["kind"] in TOPIC_LIKE_KINDS:
-                self.topics_by_slug[node["slug"]] = node
+        # Open the mapping for slug to metadata, which replaces the topic
+        # metadata in METADATA_BY_SLUG with the resource metadata
+        if not os.path.exists(METADATA_MAPPING_FILE):
+            LOGGER.info("Metadata mapping not found; generating it from English TSV")
+            generate_metadata_mapping(update=update)
+        try:
+            global metadata_store
+            metadata_store = MetadataMappingStore(METADATA_MAPPING_FILE)
+            LOGGER.info(
+                f"Opened metadata mapping for {len(metadata_store)} slugs from {METADATA_MAPPING_FILE}"
+            )
+        except (sqlite3.Error, IOError) as e:
+            LOGGER.error(f"Failed to load metadata mapping. Rerun with lang=en and no variant to force generation.")
+            exit(1)
 
-        self.slug_blacklist = get_slug_blacklist(lang=lang, variant=variant)
-        self.topic_replacements = get_topic_tree_replacements(
-            lang=lang, variant=variant
-        )
+        self._load_curation()
 
-        for child_pointer in root_children:
-            if "id" in child_pointer and child_pointer["id"] in self.tree_dict:
-                child_node = self.tree_dict[child_pointer["id"]]
-                self._recurse_create(channel, child_node)
+        for child_node in self._get_domain_nodes():
+            self._recurse_create(channel, child_node)
         if self.verbose:
             with open("node_report.txt", "w") as f:
                 f.writelines(self.node_report)
 
-        # Generate metadata mapping if in generation mode
-        if self.generate_metadata:
-            self._generate_metadata_mapping()
-            exit(0)
+        # Optionally copy the tree into the hires version of the channel
+        if hires_channel is not None:
+            self._clone_tree(channel, hires_channel)
+
+        # Fetch the remaining exercises (items are used in KhanExercise.validate)
+        self.prefetcher.flush()
+
+        # Wait for the subtitle files that were queued while building the tree
+        for video in self.subtitled_videos:
+            video.add_subtitle_files()
+        self.subtitle_cache.log_counters()
+        if self.thumbnail_cache is not None:
+            self._set_local_thumbnails(channel)
+            if hires_channel is not None:
+                self._set_local_thumbnails(hires_channel)
+            self.thumbnail_cache.log_counters()
+        if self.transcode_pool is not None:
+            self.transcode_pool.start()
+        if self.source_index is not None:
+            self.source_index.log_counters()
+
+    def _set_local_thumbnails(self, node):
+        """
+        Replace the thumbnail URLs of `node` and its descendants by the local
+        paths of the files in the thumbnail cache.
+        """
+        for file in node.files:
+            if isinstance(file, ThumbnailFile) and file.path.startswith("http"):
+                file.path = self.thumbnail_cache.get_path(file.path)
+        for child in node.children:
+            self._set_local_thumbnails(child)
+
+    def _clone_tree(self, channel, hires_channel):
+        """
+        Copy the tree built for `channel` into `hires_channel`, the hires version
+        of the same channel, so the TSV data, translations, assessment items, and
+        subtitles are only loaded once. Only the remote nodes and the video files
+        are set again for the hires channel.
+        """
+        LOGGER.info("Copying the topic tree to the hires channel")
+        hires_channel_id = hires_channel.get_node_id().hex
+        hires_remote_nodes = get_nodes_for_remote_files(hires_channel_id)
+        for child in channel.children:
+            self._clone_node(hires_channel, child, hires_channel_id, hires_remote_nodes)
+
+    def _clone_node(self, parent, node, channel_id, remote_nodes):
+        clone = copy.copy(node)
+        clone.parent = None
+        clone.node_id = None
+        clone.children = []
+        clone.files = []
+        clone.extra_fields = copy.deepcopy(node.extra_fields)
+        parent.add_child(clone)
+        for file in node.files:
+            if isinstance(file, (VideoFile, SubtitleFile)):
+                continue  # set again below
+            file_clone = copy.copy(file)
+            if hasattr(file, "context"):
+                file_clone.context = dict(file.context)
+            clone.add_file(file_clone)
+            if node.thumbnail is file:
+                clone.thumbnail = file_clone
+
+        if isinstance(node, KhanExercise):
+            clone.questions = []
+            clone.remote_node = False
+            if self.reuse_exercises:
+                clone._set_remote_node(remote_nodes, channel_id, self.item_store)
+            if not clone.remote_node:
+                clone.item_store = self.item_store
+                clone.asset_prefetcher = self.asset_prefetcher
+                clone.question_store = self.question_store
+                clone.prefetched_items = self.prefetcher.add(
+                    clone.khan_id, clone.assessment_items
+                )
+        elif isinstance(node, KhanVideo):
+            clone.hires = True
+            clone.channel_id = channel_id
+            clone.remote_node = False
+            clone.source_channel_id = None
+            clone.source_node_id = None
+            clone.video_file = None
+            clone.transcode_future = None
+            clone.subtitle_futures = []
+            # The subtitle files are already in the subtitle cache
+            clone._set_video_files(
+                remote_nodes,
+                self.subtitle_cache,
+                self.video_index,
+                self.source_index,
+                self.transcode_cache,
+            )
+            clone.add_subtitle_files()
+            if self.transcode_pool is not None and clone.video_file is not None:
+                self.transcode_pool.add(clone, clone.tsv_duration)
+        for child in node.children:
+            self._clone_node(clone, child, channel_id, remote_nodes)
 
     @property
     def variant_only(self):
@@ -213,86 +392,131 @@ class TSVManager:
             and (self.lang, self.variant) not in TOPIC_TREE_REPLACMENTS_PER_LANG
         )
 
-    def _generate_metadata_mapping(self):
+    def _load_curation(self):
         """
-        Generate metadata mapping from collected nodes and save to JSON file.
+        Load the slug blacklist and topic tree replacements for this channel.
         """
-        LOGGER.info("Generating metadata mapping...")
-        metadata_mapping = {}
-        
-        for slug, nodes in self.collected_nodes.items():
-            # Collect all grade_levels and categories values from all nodes with this slug
-            grade_levels = set()
-            categories = set()
-            
-            for node in nodes:
-                if node.grade_levels:
-                    grade_levels.update(node.grade_levels)
-                
-                if node.categories:
-                    categories.update(node.categories)
-            
-            # Convert sets to sorted lists
-            grade_levels_list = sorted(list(grade_levels))
-            categories_list = self._remove_prefix_categories(categories)
+        # Build a lookup table {slug --> KhanTopic} to be used for replacement logic
+        self.topics_by_slug = {}
 
-            # Only add to mapping if we have metadata
-            if grade_levels_list or categories_list:
-                metadata_mapping[slug] = {}
-                if grade_levels_list:
-                    metadata_mapping[slug]['grade_levels'] = grade_levels_list
-                if categories_list:
-                    metadata_mapping[slug]['categories'] = categories_list
+        for node in self.tree_dict.values():
+            if node["kind"] in TOPIC_LIKE_KINDS:
+                self.topics_by_slug[node["slug"]] = node
 
-        # Save to file
-        with open(METADATA_MAPPING_FILE, 'w', encoding='utf-8') as f:
-            json.dump(metadata_mapping, f)
+        self.slug_blacklist = get_slug_blacklist(lang=self.lang, variant=self.variant)
+        self.topic_replacements = compile_topic_tree_replacements(
+            self.topics_by_slug, lang=self.lang, variant=self.variant
+        )
+        self.replaced_slugs = set()  # each slug is replaced only the first time
 
-        LOGGER.info(f"Generated metadata mapping for {len(metadata_mapping)} slugs")
+    def _get_domain_nodes(self):
+        """
+        Return the Domain rows of the TSV data in DOMAINS_SORT_ORDER.
+        """
+        domains = [row for row in self.tree_dict.values() if row["kind"] == "Domain"]
+        domains_by_slug = dict((domain["slug"], domain) for domain in domains)
+        return [
+            domains_by_slug[domain_slug]
+            for domain_slug in DOMAINS_SORT_ORDER
+            if domain_slug in domains_by_slug
+        ]
 
-    def _remove_prefix_categories(self, categories):
+    def _skip_node(self, node):
         """
-        Remove categories that are prefixes of other categories.
+        Returns True if the TSV row `node` should not be included in the channel.
         """
-        sorted_categories = sorted(categories)
-        filtered = []
-        
-        for i, category in enumerate(sorted_categories):
-            is_prefix = False
-            for j, other_category in enumerate(sorted_categories):
-                if i != j and other_category.startswith(category):
-                    is_prefix = True
-                    break
-            if not is_prefix:
-                filtered.append(category)
-        
-        return filtered
-
-    def _create_replacement_node(self, parent, child):
-        fake_child_id = "{}_{}".format(parent["slug"], child["slug"])
-        if child["slug"] in self.topics_by_slug:
-            child_node = self.topics_by_slug[child["slug"]].copy()
-        else:
-            child_node = {
-                "translated_description_html": "",
-                "curriculum_key": "",
-                "kind": "Course",
-                "fully_translated": True,
-            }
-        child_node.update(
-            {
-                "id": fake_child_id,
-                "original_title": child.get(
-                    "translatedTitle", child_node.get("original_title", "")
-                ),
-                "translated_title": child.get(
-                    "translatedTitle", child_node.get("translated_title", "")
-                ),
-                "slug": child["slug"],
-            }
-        )
-        self.tree_dict[fake_child_id] = child_node
-        return child_node
+        # Only do this exclusion for topic like nodes, as this flag seems to gate what appears in top level
+        # navigation. Many resources get excluded by this, even though they are still accessible under their
+        # parent topic.
+        if (
+            self.onlylisted
+            and node["kind"] in TOPIC_LIKE_KINDS
+            and (not node.get("listed", True) and not node.get("fully_translated", False))
+        ):
+            LOGGER.warning(node["original_title"] + " is not fully_translated")
+            return True  # we want to keep only topic nodes with `fully_translated=True`
+
+        if node["slug"] in self.slug_blacklist:
+            LOGGER.warning(node["original_title"] + " is in the blacklist")
+            return True
+
+        if (
+            self.variant
+            and node["curriculum_key"]
+            and node["curriculum_key"] != self.variant
+        ):
+            LOGGER.warning(node["original_title"] + " is not in the variant")
+            return True
+
+        if (
+            self.variant_only
+            and node["kind"] == "Course"
+            and node["curriculum_key"] != self.variant
+        ):
+            LOGGER.warning(node["original_title"] + " is a course and not in the variant")
+            return True
+
+        # The English TSV does not contain this information, and all content is created in English
+        # so it is always fully translated. If it is not fully translated we do not include it.
+        if node["kind"] not in TOPIC_LIKE_KINDS and not node.get("fully_translated", True):
+            LOGGER.warning(node["original_title"] + " is not fully translated")
+            return True
+
+        return False
+
+    def _get_replacement_nodes(self, node, title):
+        """
+        Returns the list of overlay nodes that replace the topic `node` according
+        to the topic tree replacements, or None if `node` should not be replaced.
+        """
+        slug = node["slug"]
+        if slug not in self.topic_replacements or slug in self.replaced_slugs:
+            return None
+        self.replaced_slugs.add(slug)
+        r_nodes = []
+        for replacement in self.topic_replacements[slug]:
+            r_title = replacement["title"]
+            if r_title is None:
+                r_title = title
+            # overlay on top of `node` with the replacement children
+            r_node = ChainMap(
+                {
+                    "original_title": r_title,
+                    "translated_title": r_title,
+                    "slug": replacement["slug"],
+                    "replacement_children": replacement["children"],
+                },
+                node,
+            )
+            r_nodes.append(r_node)
+        return r_nodes
+
+    def _get_child_nodes(self, node):
+        """
+        Yield the children of the topic-like `node`: either the overlay nodes
+        specified by a topic tree replacement, or the rows in `children_ids`.
+        """
+        if "replacement_children" in node:
+            yield from node["replacement_children"]
+            return
+        for child_pointer in node.get("children_ids", []):
+            if "id" in child_pointer and child_pointer["id"] in self.tree_dict:
+                yield self.tree_dict[child_pointer["id"]]
+            else:
+                if (
+                    "kind" in child_pointer
+                    and child_pointer["kind"] not in SUPPORTED_KINDS
+                ):
+                    # silentry skip unsupported content kinds like Article, Project,
+                    # Talkthrough, Challenge, Interactive, TopicQuiz, TopicUnitTest
+                    pass
+                else:
+                    LOGGER.warning(
+                        "Missing id="
+                        + child_pointer.get("id")
+                        + " in children_ids of topic node with id="
+                        + node["id"]
+                    )
 
     def _share_sibling_metadata(self, topic_node):
         """
@@ -364,41 +588,7 @@ class TSVManager:
                 prefix = "INCLUDE: "
             self.node_report.append(prefix + text)
 
-        # Only do this exclusion for topic like nodes, as this flag seems to gate what appears in top level
-        # navigation. Many resources get excluded by this, even though they are still accessible under their
-        # parent topic.
-        if (
-            self.onlylisted
-            and node["kind"] in TOPIC_LIKE_KINDS
-            and (not node.get("listed", True) and not node.get("fully_translated", False))
-        ):
-            LOGGER.warning(node["original_title"] + " is not fully_translated")
-            return None  # we want to keep only topic nodes with `fully_translated=True`
-
-        if node["slug"] in self.slug_blacklist:
-            LOGGER.warning(node["original_title"] + " is in the blacklist")
-            return None
-
-        if (
-            self.variant
-            and node["curriculum_key"]
-            and node["curriculum_key"] != self.variant
-        ):
-            LOGGER.warning(node["original_title"] + " is not in the variant")
-            return None
-
-        if (
-            self.variant_only
-            and node["kind"] == "Course"
-            and node["curriculum_key"] != self.variant
-        ):
-            LOGGER.warning(node["original_title"] + " is a course and not in the variant")
-            return None
-
-        # The English TSV does not contain this information, and all content is created in English
-        # so it is always fully translated. If it is not fully translated we do not include it.
-        if node["kind"] not in TOPIC_LIKE_KINDS and not node.get("fully_translated", True):
-            LOGGER.warning(node["original_title"] + " is not fully translated")
+        if self._skip_node(node):
             return None
 
         # Title info comes form different place if `en` vs. translated trees
@@ -438,38 +628,24 @@ class TSVManager:
             )
             parent.add_child(khan_node)
             khan_node.set_metadata_from_ancestors()
-            
-            # Collect node for metadata generation
-            if self.generate_metadata:
-                if slug_no_prefix not in self.collected_nodes:
-                    self.collected_nodes[slug_no_prefix] = []
-                self.collected_nodes[slug_no_prefix].append(khan_node)
+            # Unchanged exercises reuse the existing Studio node (needs the node id)
+            if self.reuse_exercises:
+                khan_node._set_remote_node(
+                    self.remote_nodes, self.channel_id, self.item_store
+                )
+            if not khan_node.remote_node:
+                khan_node.item_store = self.item_store
+                khan_node.asset_prefetcher = self.asset_prefetcher
+                khan_node.question_store = self.question_store
+                khan_node.prefetched_items = self.prefetcher.add(
+                    khan_node.khan_id, khan_node.assessment_items
+                )
 
         elif node["kind"] in TOPIC_LIKE_KINDS:
             slug = node["slug"]
-            if slug in self.topic_replacements:
-                replacements = self.topic_replacements.pop(slug)
-                for replacement in replacements:
-                    children_ids = []
-                    r_node = node.copy()
-                    for child in replacement["children"]:
-                        child_node = self._create_replacement_node(replacement, child)
-                        if "children" in child:
-                            gchild_ids = []
-                            for gchild in child["children"]:
-                                gchild_node = self._create_replacement_node(
-                                    child_node, gchild
-                                )
-                                gchild_ids.append({"id": gchild_node["id"]})
-                            child_node["children_ids"] = gchild_ids
-                        children_ids.append({"id": child_node["id"]})
-
-                    r_node["original_title"] = replacement.get("translatedTitle", title)
-                    r_node["translated_title"] = replacement.get(
-                        "translatedTitle", title
-                    )
-                    r_node["slug"] = replacement.get("slug", slug)
-                    r_node["children_ids"] = children_ids
+            r_nodes = self._get_replacement_nodes(node, title)
+            if r_nodes is not None:
+                for r_node in r_nodes:
                     self._recurse_create(parent, r_node, level=level + 1)
             else:
                 khan_node = KhanTopic(
@@ -479,25 +655,8 @@ class TSVManager:
                 )
                 parent.add_child(khan_node)
 
-                for child_pointer in node.get("children_ids", []):
-                    if "id" in child_pointer and child_pointer["id"] in self.tree_dict:
-                        child_node = self.tree_dict[child_pointer["id"]]
-                        self._recurse_create(khan_node, child_node, level=level + 1)
-                    else:
-                        if (
-                            "kind" in child_pointer
-                            and child_pointer["kind"] not in SUPPORTED_KINDS
-                        ):
-                            # silentry skip unsupported content kinds like Article, Project,
-                            # Talkthrough, Challenge, Interactive, TopicQuiz, TopicUnitTest
-                            pass
-                        else:
-                            LOGGER.warning(
-                                "Missing id="
-                                + child_pointer.get("id")
-                                + " in children_ids of topic node with id="
-                                + node["id"]
-                            )
+                for child_node in self._get_child_nodes(node):
+                    self._recurse_create(khan_node, child_node, level=level + 1)
 
                 # Share metadata among resource siblings
                 self._share_sibling_metadata(khan_node)
@@ -560,16 +719,22 @@ class TSVManager:
             # Add the video to the parent before setting any files, as we need the node id
             # to lookup any potentially pre-existing remote files.
             parent.add_child(khan_node)
-            khan_node._set_video_files(self.remote_nodes)
+            khan_node._set_video_files(
+                self.remote_nodes,
+                self.subtitle_cache,
+                self.video_index,
+                self.source_index,
+                self.transcode_cache,
+            )
+            if khan_node.subtitle_futures:
+                self.subtitled_videos.append(khan_node)
+            khan_node.tsv_duration = node.get("duration")
+            if self.transcode_pool is not None and khan_node.video_file is not None:
+                self.transcode_pool.add(khan_node, khan_node.tsv_duration)
             khan_node.set_metadata_from_ancestors()
-            
-            # Collect node for metadata generation
+
             if not khan_node.has_video_file:
                 parent.children.remove(khan_node)
-            elif self.generate_metadata:
-                if slug_no_prefix not in self.collected_nodes:
-                    self.collected_nodes[slug_no_prefix] = []
-                self.collected_nodes[slug_no_prefix].append(khan_node)
         else:
             if node["kind"] in UNSUPPORTED_KINDS:
                 # silentry skip unsupported content kinds like Article, Project,
@@ -579,6 +744,155 @@ class TSVManager:
                 LOGGER.warning("Unrecognized node kind " + node["kind"] + " " + title)
 
 
+# METADATA MAPPING
+################################################################################
+
+
+def _remove_prefix_values(values):
+    """
+    Return the sorted list of `values` without those that are prefixes of other
+    values, e.g. a broad category when a more specific category is present.
+    """
+    return sorted(
+        value
+        for value in set(values)
+        if not any(other != value and other.startswith(value) for other in values)
+    )
+
+
+class TSVMetadataMapper(TSVManager):
+    """
+    Walk the English TSV tree the same way TSVManager does (same filtering and
+    topic tree replacements) and compute the grade_levels and categories that
+    each exercise and video inherits from the topics in METADATA_BY_SLUG and
+    shares with its siblings, without creating any ricecooker nodes and without
+    any network requests.
+    """
+
+    def __init__(self, tree_dict):
+        self.tree_dict = tree_dict
+        self.lang = "en"
+        self.variant = None
+        self.onlylisted = True
+        self.verbose = False
+        self.collected_metadata = {}  # {slug --> list of metadata dicts}
+        self._load_curation()
+        for domain in self._get_domain_nodes():
+            self._recurse_collect(domain, {"grade_levels": [], "categories": []})
+
+    def _get_node_metadata(self, slug, ancestor_metadata):
+        """
+        Combine the `ancestor_metadata` with the metadata for `slug` the same way
+        ricecooker does when inheriting metadata from ancestor nodes.
+        """
+        metadata = {}
+        node_metadata = METADATA_BY_SLUG.get(slug, {})
+        for field in ["grade_levels", "categories"]:
+            values = set(ancestor_metadata[field]) | set(node_metadata.get(field, []))
+            metadata[field] = _remove_prefix_values(values)
+        return metadata
+
+    def _recurse_collect(self, node, ancestor_metadata):
+        """
+        Returns a tuple (slug, metadata) for resource nodes that are included in
+        the channel, or None for topics and nodes that are skipped.
+        """
+        if self._skip_node(node):
+            return None
+
+        if node["kind"] == "Exercise":
+            slug_no_prefix = node["slug"].replace("e/", "")
+            return slug_no_prefix, self._get_node_metadata(
+                slug_no_prefix, ancestor_metadata
+            )
+
+        elif node["kind"] == "Video":
+            # Same checks as the ones done when creating KhanVideo nodes
+            if not node["download_urls"] or node["license"] not in LICENSE_MAPPING:
+                return None
+            filetypes = [durl["filetype"] for durl in node["download_urls"]]
+            if not set(filetypes) & {"mp4", "mp4-low", "mp4-low-ios"}:
+                return None
+            slug_no_prefix = node["slug"].replace("v/", "")
+            return slug_no_prefix, self._get_node_metadata(
+                slug_no_prefix, ancestor_metadata
+            )
+
+        elif node["kind"] in TOPIC_LIKE_KINDS:
+            r_nodes = self._get_replacement_nodes(node, node["original_title"])
+            if r_nodes is not None:
+                for r_node in r_nodes:
+                    self._recurse_collect(r_node, ancestor_metadata)
+                return None
+            topic_metadata = self._get_node_metadata(node["slug"], ancestor_metadata)
+            resources = []
+            for child_node in self._get_child_nodes(node):
+                resource = self._recurse_collect(child_node, topic_metadata)
+                if resource is not None:
+                    resources.append(resource)
+            self._share_sibling_metadata_dicts([md for _, md in resources])
+            for slug, resource_metadata in resources:
+                self.collected_metadata.setdefault(slug, []).append(resource_metadata)
+        return None
+
+    def _share_sibling_metadata_dicts(self, resources_metadata):
+        """
+        Same as `_share_sibling_metadata` but for the resource metadata dicts.
+        """
+        if len(resources_metadata) <= 1:
+            return
+        all_categories = set()
+        all_grade_levels = set()
+        for metadata in resources_metadata:
+            all_categories.update(metadata["categories"])
+            all_grade_levels.update(metadata["grade_levels"])
+        final_categories = _remove_prefix_values(all_categories)
+        final_grade_levels = sorted(all_grade_levels)
+        for metadata in resources_metadata:
+            if all_categories:
+                metadata["categories"] = final_categories
+            if all_grade_levels:
+                metadata["grade_levels"] = final_grade_levels
+
+    def get_metadata_mapping(self):
+        """
+        Returns a dict {slug --> {grade_levels, categories}} that combines the
+        metadata of all the resource nodes that have the same slug.
+        """
+        metadata_mapping = {}
+        for slug, metadata_list in self.collected_metadata.items():
+            grade_levels = set()
+            categories = set()
+            for metadata in metadata_list:
+                grade_levels.update(metadata["grade_levels"])
+                categories.update(metadata["categories"])
+            grade_levels_list = sorted(grade_levels)
+            categories_list = _remove_prefix_values(categories)
+            # Only add to mapping if we have metadata
+            if grade_levels_list or categories_list:
+                metadata_mapping[slug] = {}
+                if grade_levels_list:
+                    metadata_mapping[slug]["grade_levels"] = grade_levels_list
+                if categories_list:
+                    metadata_mapping[slug]["categories"] = categories_list
+        return metadata_mapping
+
+
+def generate_metadata_mapping(tree_dict=None, update=False):
+    """
+    Generate the METADATA_MAPPING_FILE from the English TSV data `tree_dict`
+    (downloaded if not provided). Non-English channels use this mapping to set
+    the grade_levels and categories of the resource nodes.
+    """
+    if tree_dict is None:
+        tree_dict = get_khan_tsv("en", update=update)
+    LOGGER.info("Generating metadata mapping...")
+    metadata_mapping = TSVMetadataMapper(tree_dict).get_metadata_mapping()
+    write_metadata_mapping(metadata_mapping, db_path=METADATA_MAPPING_FILE)
+    LOGGER.info(f"Generated metadata mapping for {len(metadata_mapping)} slugs")
+    return metadata_mapping
+
+
 # EXTRACT (download TSV export files from the KHAN_TSV_EXPORT_BUCKET_NAME)
 ################################################################################
 
@@ -696,7 +1010,7 @@ def clean_tsv_row(row):
 
 class KhanTopic(TopicNode):
     def __init__(self, id, title, description):
-        metadata = METADATA_BY_SLUG.get(id, {})
+        metadata = get_slug_metadata(id)
         super(KhanTopic, self).__init__(
             id, title, description=description[:400] if description else "", **metadata
         )
@@ -705,14 +1019,46 @@ class KhanTopic(TopicNode):
         return "Topic Node: {}".format(self.title)
 
 
-assessment_item_query = """
-query LearningEquality_assessmentItems($itemDescriptors: [String]!) {
-    assessmentItems(reservedItemDescriptors: $itemDescriptors) {
-        id
-        itemData
-    }
+NO_OVERRIDE_FIELDS = {
+    "thumbnail",
+    "extra_fields",
+    "suggested_duration",
 }
-"""
+
+
+def remote_node_dict(data, node_id, source_channel_id, source_node_id):
+    """
+    Returns the dict for the node `node_id` that reuses the existing Studio node
+    `source_node_id`, with the fields in `data` used as overrides.
+    """
+    return_value = {
+        "node_id": node_id,
+        "source_channel_id": source_channel_id,
+        "source_node_id": source_node_id,
+    }
+    for key in StudioContentNode.ALLOWED_OVERRIDES:
+        if key in data and data[key] and key not in NO_OVERRIDE_FIELDS:
+            return_value[key] = data[key]
+    return return_value
+
+
+def mastery_model_matches(remote_mastery_model, exercise_data):
+    """
+    Compare the `mastery_model` JSON of a Kolibri content_assessmentmetadata row
+    with the `exercise_data` of an exercise. The m and n values are compared only
+    when they are set explicitly in `exercise_data`, since otherwise they depend
+    on the number of questions.
+    """
+    try:
+        remote_mastery_model = json.loads(remote_mastery_model)
+    except (TypeError, ValueError):
+        return False
+    if remote_mastery_model.get("type") != exercise_data.get("mastery_model"):
+        return False
+    for key in ["m", "n"]:
+        if exercise_data.get(key) and remote_mastery_model.get(key) != exercise_data[key]:
+            return False
+    return True
 
 
 class KhanExercise(ExerciseNode):
@@ -747,8 +1093,16 @@ class KhanExercise(ExerciseNode):
 
         self.khan_id = id
         self._assessment_items_set = False
+        self.prefetched_items = None  # Future for the items (see TSVManager)
+        self.item_store = None  # AssessmentItemStore used for the fallback fetch
+        self.asset_prefetcher = None  # PerseusAssetPrefetcher for the item images
+        self.prefetched_assets = []  # Futures for the item images
+        self.question_store = None  # QuestionSpillStore when not kept in memory
+        self.remote_node = False
+        self.channel_id = None
+        self.content_node_id = None
 
-        metadata = METADATA_BY_SLUG.get(slug, {})
+        metadata = get_slug_metadata(slug)
 
         super(KhanExercise, self).__init__(
             slug,
@@ -775,9 +1129,75 @@ class KhanExercise(ExerciseNode):
         )
 
     def validate(self):
-        self.set_assessment_items()
+        if not self.remote_node:
+            self.set_assessment_items()
         super(KhanExercise, self).validate()
 
+    def _validate(self):
+        if not self.remote_node:
+            return super(KhanExercise, self)._validate()
+        return Node._validate(self)
+
+    def process_files(self):
+        if not self.remote_node:
+            # Wait for the item images to be in the ricecooker cache
+            if self.asset_prefetcher is not None:
+                self.asset_prefetcher.wait(self.prefetched_assets)
+            return super(KhanExercise, self).process_files()
+        return Node.process_files(self)
+
+    def to_dict(self):
+        data = super(KhanExercise, self).to_dict()
+        if not self.remote_node:
+            return data
+        return remote_node_dict(
+            data, self.content_node_id, self.channel_id, self.content_node_id
+        )
+
+    def _set_remote_node(self, remote_nodes, channel_id, item_store=None):
+        """
+        Reuse the existing Studio node of this exercise if its assessment items
+        and mastery model are the same as in the channel's Kolibri database.
+        When all the items of the exercise are in the AssessmentItemStore
+        `item_store`, only the items with data are compared (the others are not
+        questions of the node), and the mastery model of fuv exercises, which
+        depends on the number of questions, is computed from them. Otherwise fuv
+        exercises are not reused, since their items must be fetched first.
+        """
+        self.channel_id = channel_id
+        self.content_node_id = self.get_node_id().hex
+        metadata = remote_nodes.get_assessment_metadata(self.content_node_id)
+        if metadata is None:
+            return
+        question_ids = None
+        if item_store is not None:
+            stored = item_store.get_items(self.khan_id, self.assessment_items)
+            if len(stored) == len(set(self.assessment_items)):
+                question_ids = get_item_ids_with_data(
+                    [item for item in stored.values() if item is not None]
+                )
+        exercise_data = self.extra_fields
+        if self.language == "fuv":
+            if question_ids is None:
+                return
+            number_correct = min(len(question_ids), 10)
+            exercise_data = dict(
+                exercise_data,
+                mastery_model=exercises.M_OF_N,
+                m=number_correct,
+                n=number_correct,
+            )
+        if question_ids is None:
+            question_ids = self.assessment_items
+        item_ids = set(
+            uuid.uuid5(uuid.NAMESPACE_DNS, item_id).hex for item_id in question_ids
+        )
+        if item_ids != set(metadata["assessment_item_ids"]):
+            return
+        if not mastery_model_matches(metadata["mastery_model"], exercise_data):
+            return
+        self.remote_node = True
+
     def add_question(self, item):
         if item["itemData"] and item["itemData"] != "null":
             assessment_item = PerseusQuestion(
@@ -788,65 +1208,116 @@ class KhanExercise(ExerciseNode):
             )
             self.questions.append(assessment_item)
 
-    def get_query_data(self, assessment_items):
-        return {
-            "query": assessment_item_query,
-            "variables": {
-                "itemDescriptors": [
-                    "{}|{}".format(self.khan_id, ai_id) for ai_id in assessment_items
-                ]
-            },
-        }
-
     def set_assessment_items(self):
         if self._assessment_items_set:
             return
-        kalang = KHAN_ACADEMY_LANGUAGE_MAPPING.get(self.language, self.language)
-        url = "https://{}.khanacademy.org/graphql/LearningEquality_assessmentItems".format(
-            kalang
-        )
-        data = self.get_query_data(self.assessment_items)
-
-        response_data = post_request(url, data)
-
-        if response_data:
-            # It seems that sometimes assessmentItems can be None.
-            assessment_items = response_data.get("data", {}).get("assessmentItems")
-            errors = response_data.get("errors", [])
-            missing_items = any(
-                "assessment item not found in exercise" in x["message"] for x in errors
+        assessment_items = None
+        if self.prefetched_items is not None:
+            assessment_items = self.prefetched_items.result()
+            self.prefetched_items = None
+            if assessment_items is not None and self.question_store is not None:
+                # the prefetcher returns the item ids (see TSVManager)
+                self.add_spilled_questions(assessment_items)
+                return
+        if assessment_items is None:
+            kalang = KHAN_ACADEMY_LANGUAGE_MAPPING.get(self.language, self.language)
+            url = get_assessment_items_url(kalang)
+            assessment_items = fetch_assessment_items(
+                url, {self.khan_id: self.assessment_items}, store=self.item_store
+            ).get(self.khan_id)
+            if assessment_items is not None and self.question_store is not None:
+                self.add_spilled_questions(get_item_ids_with_data(assessment_items))
+                return
+        self.add_assessment_items(assessment_items)
+
+    def add_spilled_questions(self, item_ids):
+        """
+        Add the items `item_ids` (which are in the item store) as questions whose
+        data is read from disk when needed.
+        """
+        if self._assessment_items_set:
+            return
+        ka_language = KHAN_ACADEMY_LANGUAGE_MAPPING.get(self.lang, self.lang)
+        for item_id in item_ids:
+            self.questions.append(
+                SpilledPerseusQuestion(
+                    item_id,
+                    self.khan_id,
+                    self.item_store,
+                    self.question_store,
+                    ka_language,
+                    source_url=self.source_url,
+                )
             )
-            if assessment_items is None:
-                assessment_items = []
-            if missing_items:
-                for ai in self.assessment_items:
-                    data = self.get_query_data([ai])
-                    response_data = post_request(url, data)
-                    if response_data:
-                        items = response_data.get("data", {}).get("assessmentItems")
-                        if items:
-                            assessment_items.append(items[0])
+        if self.asset_prefetcher is not None:
+            self.prefetched_assets = self.asset_prefetcher.add_stored_items(
+                self.item_store, self.khan_id, item_ids
+            )
+        self._set_fuv_mastery_model()
+        self._assessment_items_set = True
+
+    def add_assessment_items(self, assessment_items):
+        """
+        Add the fetched `assessment_items` (None if the request failed) as questions.
+        """
+        if self._assessment_items_set:
+            return
+        if assessment_items is not None:
             for item in assessment_items:
                 self.add_question(item)
-            if self.language == "fuv":
-                # By special request from SIL International who are the primary translators and users of the Fufulde channel
-                # we are setting the mastery model to 10 out of 10 for all exercises.
-                # Unless there are fewer than 10 questions in the exercise, in which case the mastery model is set to 100%.
-                number_correct = min(len(self.questions), 10)
-                self.extra_fields["mastery_model"] = exercises.M_OF_N
-                self.extra_fields["m"] = number_correct
-                self.extra_fields["n"] = number_correct
+            if self.asset_prefetcher is not None:
+                self.prefetched_assets = self.asset_prefetcher.add_items(
+                    assessment_items
+                )
+            self._set_fuv_mastery_model()
         self._assessment_items_set = True
 
+    def _set_fuv_mastery_model(self):
+        if self.language == "fuv":
+            # By special request from SIL International who are the primary translators and users of the Fufulde channel
+            # we are setting the mastery model to 10 out of 10 for all exercises.
+            # Unless there are fewer than 10 questions in the exercise, in which case the mastery model is set to 100%.
+            number_correct = min(len(self.questions), 10)
+            self.extra_fields["mastery_model"] = exercises.M_OF_N
+            self.extra_fields["m"] = number_correct
+            self.extra_fields["n"] = number_correct
+
     def __repr__(self):
         return "Exercise Node: {}".format(self.title)
 
 
-NO_OVERRIDE_FIELDS = {
-    "thumbnail",
-    "extra_fields",
-    "suggested_duration",
-}
+class SpilledPerseusQuestion(PerseusQuestion):
+    """
+    A PerseusQuestion that doesn't keep its `raw_data` in memory: the fetched
+    item data is read from the AssessmentItemStore `item_store`, and the data
+    rewritten by `process_question` is saved in the QuestionSpillStore
+    `question_store`.
+    """
+
+    def __init__(
+        self, id, exercise_id, item_store, question_store, ka_language, source_url=None
+    ):
+        self.exercise_id = exercise_id
+        self.item_store = item_store
+        self.question_store = question_store
+        self._spilled = False
+        super(SpilledPerseusQuestion, self).__init__(
+            id, "", ka_language, source_url=source_url
+        )
+        self._spill_key = "{}|{}".format(exercise_id, id)
+
+    @property
+    def raw_data(self):
+        if self._spilled:
+            return self.question_store.get(self._spill_key)
+        return self.item_store.get_item_data(self.exercise_id, self.source_id)
+
+    @raw_data.setter
+    def raw_data(self, raw_data):
+        if not hasattr(self, "_spill_key"):
+            return  # the initial value set by the constructor is not used
+        self.question_store.put(self._spill_key, raw_data)
+        self._spilled = True
 
 
 class KhanVideo(VideoNode):
@@ -873,7 +1344,7 @@ class KhanVideo(VideoNode):
         # The channel id this video belongs to.
         channel_id,
     ):
-        metadata = METADATA_BY_SLUG.get(slug, {})
+        metadata = get_slug_metadata(slug)
         super(KhanVideo, self).__init__(
             # POLICY: set the `source_id` based on the `youtube_id` of the
             # original English video and not the `translated_youtube_id`:
@@ -909,6 +1380,13 @@ class KhanVideo(VideoNode):
         self.remote_node = False
         self.channel_id = channel_id
         self.content_node_id = None
+        # The Studio node that is reused when remote_node is True
+        self.source_channel_id = None
+        self.source_node_id = None
+        self.subtitle_futures = []  # (language, url, Future for the local path)
+        self.video_file = None
+        self.transcode_future = None  # set when the video file is in the pool
+        self.tsv_duration = None  # duration in seconds from the TSV data
 
     @property
     def download_url(self):
@@ -926,56 +1404,129 @@ class KhanVideo(VideoNode):
         data = super(KhanVideo, self).to_dict()
         if not self.remote_node:
             return data
-        return_value = {
-            "node_id": self.content_node_id,
-            "source_channel_id": self.channel_id,
-            "source_node_id": self.content_node_id,
-        }
-        for key in StudioContentNode.ALLOWED_OVERRIDES:
-            if key in data and data[key] and key not in NO_OVERRIDE_FIELDS:
-                return_value[key] = data[key]
-        return return_value
-
-    def _set_video_files(self, remote_nodes):
-        self.content_node_id = self.get_node_id().hex
-
-        remote_node_files = remote_nodes.get(self.content_node_id , {}).get("files", [])
+        return remote_node_dict(
+            data, self.content_node_id, self.source_channel_id, self.source_node_id
+        )
 
-        for file in remote_node_files:
-            if (
-                file["preset"] == format_presets.VIDEO_HIGH_RES
-                or file["preset"] == format_presets.VIDEO_LOW_RES
-            ):
+    def _select_video_file(self, source_index=None):
+        """
+        Returns tuple (url, ffmpeg_settings) of the video file to download. When
+        the `source_index` is given, the smallest source that is large enough for
+        the channel is used, and it is only transcoded if it is too large.
+        """
+        max_height = 720 if self.hires else 480
+        ffmpeg_settings = {"max_height": max_height}
+        if source_index is None:
+            return self.download_url, ffmpeg_settings
+        sources = [
+            (url, source_index.get_height(url))
+            for url in [self.high_res_video, self.low_res_video, self.low_res_ios_video]
+            if url
+        ]
+        url, needs_transcode = select_video_source(sources, max_height)
+        if url is None:
+            return self.download_url, ffmpeg_settings
+        return url, ffmpeg_settings if needs_transcode else None
+
+    def process_files(self):
+        # Wait for the video file to be processed by the transcode pool, so it is
+        # in the ricecooker cache (failed jobs are processed again here)
+        if self.transcode_future is not None:
+            self.transcode_future.exception()
+        return super(KhanVideo, self).process_files()
+
+    def _set_video_files(
+        self,
+        remote_nodes,
+        subtitle_cache=None,
+        video_index=None,
+        source_index=None,
+        transcode_cache=None,
+    ):
+        self.content_node_id = self.get_node_id().hex
+        subtitles = self._get_subtitles()
+
+        self.remote_node = remote_nodes.has_video_file(self.content_node_id)
+        if self.remote_node:
+            self.source_channel_id = self.channel_id
+            self.source_node_id = self.content_node_id
+        elif video_index is not None:
+            # Look for the same video in the same language in other KA channels
+            if self.hires:
+                preset = format_presets.VIDEO_HIGH_RES
+            else:
+                preset = format_presets.VIDEO_LOW_RES
+            # A reused node is imported with its own subtitle files
+            source = video_index.find(
+                self.get_content_id().hex,
+                self.language,
+                preset,
+                subtitle_langs=[language for _, language, _ in subtitles],
+                exclude_channel_id=self.channel_id,
+            )
+            if source is not None:
+                self.source_channel_id, self.source_node_id, _ = source
                 self.remote_node = True
 
         if not self.remote_node and self.download_url:
             # If we didn't find any pre-existing remote files, add a file for download here.
-            self.add_file(
-                VideoFile(
-                    self.download_url,
-                    ffmpeg_settings={
-                        "max_height": 720 if self.hires else 480,
-                    },
+            url, ffmpeg_settings = self._select_video_file(source_index)
+            if transcode_cache is not None:
+                video_file = CachedVideoFile(
+                    url,
+                    ffmpeg_settings=ffmpeg_settings,
+                    transcode_cache=transcode_cache,
                 )
-            )
+            else:
+                video_file = PooledVideoFile(url, ffmpeg_settings=ffmpeg_settings)
+            self.add_file(video_file)
+            self.video_file = video_file
         self.has_video_file = self.remote_node or self.download_url is not None
 
-        if self.subbed:
-            target_lang = KHAN_ACADEMY_LANGUAGE_MAPPING.get(
-                self.target_lang, self.target_lang
-            )
-            for lang_code, path in get_subtitles(self.translated_youtube_id):
-                lang_obj = get_language_with_alpha2_fallback(lang_code)
-                if lang_obj is not None and (
-                    lang_code == target_lang or self.dub_subbed
-                ):
-                    self.add_file(
-                        SubtitleFile(
-                            path,
-                            language=lang_obj.code,
-                            subtitlesformat=file_formats.VTT,
-                        )
+        for lang_code, language, path in subtitles:
+            if subtitle_cache is not None:
+                future = subtitle_cache.add(self.translated_youtube_id, lang_code, path)
+                self.subtitle_futures.append((language, path, future))
+            else:
+                self.add_file(
+                    SubtitleFile(
+                        path,
+                        language=language,
+                        subtitlesformat=file_formats.VTT,
                     )
+                )
+
+    def _get_subtitles(self):
+        """
+        Returns the list of (Amara lang_code, language code, url) of the subtitles
+        that are added to this video.
+        """
+        if not self.subbed:
+            return []
+        target_lang = KHAN_ACADEMY_LANGUAGE_MAPPING.get(
+            self.target_lang, self.target_lang
+        )
+        subtitles = []
+        for lang_code, path in get_subtitles(self.translated_youtube_id):
+            lang_obj = get_language_with_alpha2_fallback(lang_code)
+            if lang_obj is not None and (lang_code == target_lang or self.dub_subbed):
+                subtitles.append((lang_code, lang_obj.code, path))
+        return subtitles
+
+    def add_subtitle_files(self):
+        """
+        Add the subtitle files queued in the subtitle cache by `_set_video_files`,
+        using the Amara URL for the files that could not be cached.
+        """
+        for language, url, future in self.subtitle_futures:
+            self.add_file(
+                SubtitleFile(
+                    future.result() or url,
+                    language=language,
+                    subtitlesformat=file_formats.VTT,
+                )
+            )
+        self.subtitle_futures = []
 
 
 # REPORTS
@@ -1065,8 +1616,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Khan Academy TSV exports viewer")
     parser.add_argument("--latest", action="store_true", help="show only most recent")
     parser.add_argument("--kalang", help="language code filter")
+    parser.add_argument(
+        "--metadatamapping",
+        action="store_true",
+        help="generate " + METADATA_MAPPING_FILE + " from the English TSV export",
+    )
     args = parser.parse_args()
 
+    if args.metadatamapping:
+        generate_metadata_mapping(update=True)
+        exit(0)
+
     all_exports = list_latest_tsv_exports()
     exports_by_kalang = dict(
         (k, list(g)) for k, g in groupby(all_exports, key=itemgetter(0))
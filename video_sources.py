@@ -0,0 +1,317 @@
+"""
+Resolution-aware selection of the source file of KA videos.
+
+Each KA video has up to three `download_urls` variants (`mp4`, `mp4-low`, and
+`mp4-low-ios`) of different resolutions. The frame size of each variant is probed
+once with `ffprobe` (which reads only the headers of the remote file) and saved
+in a local index, so that the smallest variant that meets the target height of
+the channel is downloaded, and the transcode is skipped when it is not needed.
+
+The availability and size of all the video URLs can also be checked with HEAD
+requests before the tree is built, so that dead sources are dropped early.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+from ricecooker.config import LOGGER
+
+from network import head_request
+
+
+# Index of the probed video sources {url --> (width, height, probed_at)}
+VIDEO_SOURCES_DB = os.path.join("chefdata", "videosources.sqlite3")
+
+# Number of threads used to run ffprobe on the video sources
+PROBE_WORKERS = 8
+
+# Maximum number of seconds to wait for ffprobe to read the headers of a video
+PROBE_TIMEOUT = 60
+
+# The variants of KA videos in order of preference when no probe data is available
+VIDEO_FILETYPES = ["mp4", "mp4-low", "mp4-low-ios"]
+
+# Number of threads used to check the availability of the video URLs
+URL_CHECK_WORKERS = 16
+
+# Available video URLs are checked again after this many days
+URL_CHECK_MAX_AGE_DAYS = 7
+
+# Only these statuses mean that a video URL is gone; URLs that could not be
+# checked (connection errors, throttling, server errors) are kept in the tree
+UNAVAILABLE_STATUS_CODES = {404, 410}
+
+
+def probe_video_size(url, timeout=PROBE_TIMEOUT):
+    """
+    Run `ffprobe` on the video at `url` to get the frame size of its first video
+    stream. Returns: tuple (width, height), or None if the probe failed.
+    """
+    try:
+        output = subprocess.check_output(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "stream=width,height",
+                "-of",
+                "json",
+                url,
+            ],
+            stderr=subprocess.DEVNULL,
+            timeout=timeout,
+        )
+        stream = json.loads(output)["streams"][0]
+        return int(stream["width"]), int(stream["height"])
+    except (
+        subprocess.SubprocessError,
+        OSError,
+        ValueError,
+        KeyError,
+        IndexError,
+    ) as e:
+        LOGGER.warning("Failed to probe video {}: {}".format(url, e))
+        return None
+
+
+def select_video_source(sources, max_height):
+    """
+    Select the source to download from the `sources` list of (url, height), where
+    height is None for sources that could not be probed, for a video file of at
+    most `max_height` pixels. The smallest source that is at least `max_height`
+    is preferred, else the largest source that was probed.
+    Returns: tuple (url, needs_transcode), or (None, True) if no source was probed.
+    """
+    probed = [(height, url) for url, height in sources if height]
+    if not probed:
+        return None, True
+    large_enough = [source for source in probed if source[0] >= max_height]
+    if large_enough:
+        height, url = min(large_enough)
+    else:
+        height, url = max(probed)
+    return url, height > max_height
+
+
+class VideoSourceIndex:
+    """
+    Probe the frame size of video sources in the background, and save the results
+    in `db_path` so each URL is only probed once. Each call to `add` returns a
+    future that resolves to the height of the video (None if the probe failed).
+    """
+
+    def __init__(self, db_path=VIDEO_SOURCES_DB, max_workers=PROBE_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="videoprobe"
+        )
+        self.futures = {}  # {url --> Future}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "probed": 0, "failed": 0}
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS sources (
+                    url TEXT PRIMARY KEY,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    probed_at REAL NOT NULL
+                ) WITHOUT ROWID"""
+            )
+
+    def add(self, url):
+        """
+        Queue the video at `url` for probing, unless it was already probed.
+        Returns: a Future that resolves to the height of the video (or None).
+        """
+        with self.lock:
+            if url not in self.futures:
+                self.futures[url] = self.executor.submit(self._probe, url)
+            return self.futures[url]
+
+    def add_download_urls(self, download_urls):
+        """
+        Queue all the variants in the KA `download_urls` list for probing.
+        """
+        for durl in download_urls:
+            if durl["filetype"] in VIDEO_FILETYPES and durl.get("url"):
+                self.add(durl["url"])
+
+    def get_height(self, url):
+        """
+        Returns the height of the video at `url`, probing it if needed.
+        """
+        return self.add(url).result()
+
+    def _probe(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT height FROM sources WHERE url = ?", (url,)
+            ).fetchone()
+        if row:
+            height = row[0]
+            counter = "hits"
+        else:
+            size = probe_video_size(url)
+            if size:
+                width, height = size
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO sources (url, width, height, probed_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (url, width, height, time.time()),
+                    )
+                counter = "probed"
+            else:
+                # Failures are not saved so the video is probed again next run
+                height = None
+                counter = "failed"
+        with self.lock:
+            self.counters[counter] += 1
+        return height
+
+    def log_counters(self):
+        LOGGER.info(
+            "Video sources probe: {hits} hits, {probed} probed, "
+            "{failed} failed".format(**self.counters)
+        )
+
+
+class VideoURLChecker:
+    """
+    Check the availability and the size of video URLs with concurrent HEAD
+    requests before the tree is built. The results are saved in `db_path`, and
+    available URLs are not checked again until they are older than `max_age_days`
+    (the other URLs are checked again in each run). URLs are only considered
+    unavailable if the server replied with one of UNAVAILABLE_STATUS_CODES.
+    """
+
+    def __init__(
+        self,
+        db_path=VIDEO_SOURCES_DB,
+        max_workers=URL_CHECK_WORKERS,
+        max_age_days=URL_CHECK_MAX_AGE_DAYS,
+    ):
+        self.max_workers = max_workers
+        self.max_age = max_age_days * 24 * 3600
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    status INTEGER,
+                    size INTEGER,
+                    checked_at REAL NOT NULL
+                ) WITHOUT ROWID"""
+            )
+
+    def _check(self, url):
+        status, size = head_request(url)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls (url, status, size, checked_at) "
+                "VALUES (?, ?, ?, ?)",
+                (url, status, size, time.time()),
+            )
+        return status, size
+
+    def check_urls(self, urls):
+        """
+        Returns: dict {url --> (available, size in bytes or None)} for all `urls`.
+        """
+        results = {}
+        with self.lock:
+            for url, status, size in self.conn.execute(
+                "SELECT url, status, size FROM urls "
+                "WHERE status = 200 AND checked_at >= ?",
+                (time.time() - self.max_age,),
+            ):
+                results[url] = (True, size)
+        results = dict((url, results[url]) for url in urls if url in results)
+        to_check = sorted(set(urls) - set(results))
+        LOGGER.info(
+            "Checking {} video URLs ({} checked recently)".format(
+                len(to_check), len(results)
+            )
+        )
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="urlcheck"
+        ) as executor:
+            for url, (status, size) in zip(to_check, executor.map(self._check, to_check)):
+                results[url] = (status not in UNAVAILABLE_STATUS_CODES, size)
+        return results
+
+    def check_tree(self, tree_dict):
+        """
+        Check the `download_urls` of the videos in `tree_dict`, and remove the
+        unavailable URLs from them, so videos without any available URL are
+        skipped when building the tree. The download volume is estimated from the
+        size of the source used by default (the first available of VIDEO_FILETYPES)
+        and of the smallest available source.
+        Returns: dict with the counts of URLs and videos and the estimated bytes.
+        """
+        videos = [
+            node
+            for node in tree_dict.values()
+            if node["kind"] == "Video"
+            and node["download_urls"]
+            and node.get("fully_translated", True)
+        ]
+        urls = set(
+            durl["url"]
+            for node in videos
+            for durl in node["download_urls"]
+            if durl["filetype"] in VIDEO_FILETYPES and durl.get("url")
+        )
+        results = self.check_urls(urls)
+        stats = {
+            "urls": len(urls),
+            "dead_urls": 0,
+            "dead_videos": 0,
+            "default_bytes": 0,
+            "smallest_bytes": 0,
+        }
+        for node in videos:
+            available = []
+            for durl in node["download_urls"]:
+                ok, size = results.get(durl.get("url"), (True, None))
+                if ok:
+                    available.append(durl)
+                else:
+                    LOGGER.warning("Unavailable video URL " + durl["url"])
+                    stats["dead_urls"] += 1
+            node["download_urls"] = available
+            sizes = dict(
+                (durl["filetype"], results[durl["url"]][1])
+                for durl in available
+                if durl["filetype"] in VIDEO_FILETYPES and durl["url"] in results
+            )
+            sizes = dict((filetype, size) for filetype, size in sizes.items() if size)
+            if not sizes:
+                if not available:
+                    stats["dead_videos"] += 1
+                continue
+            default = next(ft for ft in VIDEO_FILETYPES if ft in sizes)
+            stats["default_bytes"] += sizes[default]
+            stats["smallest_bytes"] += min(sizes.values())
+        LOGGER.info(
+            "Video URLs check: {urls} URLs, {dead_urls} unavailable, {dead_videos} "
+            "videos without sources; estimated download {default_gb:.1f}GB "
+            "({smallest_gb:.1f}GB with the smallest sources)".format(
+                default_gb=stats["default_bytes"] / 1024 ** 3,
+                smallest_gb=stats["smallest_bytes"] / 1024 ** 3,
+                **stats
+            )
+        )
+        return stats